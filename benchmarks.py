@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+'''
+Benchmarks of the cart views, to run from the test case of the Galatea
+application (like tests.py), with a Tryton database (SQLite is enough).
+
+The test case provides:
+    client: Flask test client (logged in or anonymous)
+    language: language of the urls
+    product_ids: ids of salable products of the shop
+    product_codes: codes of the same products (cart files)
+    checkout_data: form data to post to checkout and confirm
+
+The baseline compares the ratio of each benchmark to a fixed CPU workload
+measured in the same run (calibrate), not milliseconds, so it does not
+depend on the speed of the machine.
+
+Example (tests.cart_benchmarks):
+    results = benchmarks.run_benchmarks(self)
+    benchmarks.assert_baseline(results, 'cart-benchmarks.json')
+'''
+import hashlib
+import io
+import json
+import os
+import time
+from flask import url_for
+
+CART_SIZES = (1, 10, 100, 1000)
+FILE_ROWS = (1000, 10000, 50000)
+
+
+def measure(func, repeat=10, setup=None):
+    '''
+    Call func repeat times and return its latency (milliseconds) and
+    throughput (calls by second). setup is called before each call and is
+    not measured.
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    total = sum(times)
+    return {
+        'count': repeat,
+        'min': round(times[0] * 1000, 2),
+        'median': round(times[len(times) // 2] * 1000, 2),
+        'p95': round(times[min(int(len(times) * 0.95), len(times) - 1)]
+            * 1000, 2),
+        'max': round(times[-1] * 1000, 2),
+        'rps': round(repeat / total, 2) if total else None,
+        }
+
+
+def calibrate(repeat=20):
+    '''Median milliseconds of a fixed CPU workload (the unit of the ratios)'''
+    data = list(range(20000))
+
+    def workload():
+        hashlib.md5(json.dumps(sorted(data, reverse=True)).encode('utf-8')
+            ).hexdigest()
+    return measure(workload, repeat=repeat)['median']
+
+
+def _add(self, quantities):
+    response = self.client.post(url_for('cart.add', lang=self.language),
+        data=dict(('product-%s' % product_id, quantity)
+            for product_id, quantity in quantities.items()))
+    assert response.status_code in (200, 302)
+    return response
+
+
+def fill_cart(self, size, quantity=1):
+    '''Set the cart with the first size products'''
+    clear_cart(self)
+    product_ids = self.product_ids[:size]
+    assert len(product_ids) == size, 'Not enough products (%s)' % size
+    _add(self, dict((product_id, quantity) for product_id in product_ids))
+
+
+def clear_cart(self):
+    '''Remove the lines of the cart of all products'''
+    _add(self, dict((product_id, -1) for product_id in self.product_ids))
+
+
+def bench_add(self, size, repeat=10):
+    '''Add size products to an empty cart'''
+    product_ids = self.product_ids[:size]
+    return measure(
+        lambda: _add(self, dict((p, 1) for p in product_ids)),
+        repeat=repeat, setup=lambda: clear_cart(self))
+
+
+def bench_my_cart(self, size, repeat=20):
+    '''Mini cart (JSON) of a cart of size lines'''
+    fill_cart(self, size)
+    url = url_for('cart.my-cart', lang=self.language)
+
+    def my_cart():
+        response = self.client.get(url)
+        assert response.status_code == 200
+    return measure(my_cart, repeat=repeat)
+
+
+def bench_cart_list(self, size, repeat=10):
+    '''Cart page of a cart of size lines'''
+    fill_cart(self, size)
+    url = url_for('cart.cart', lang=self.language)
+
+    def cart_list():
+        response = self.client.get(url)
+        assert response.status_code == 200
+    return measure(cart_list, repeat=repeat)
+
+
+def bench_checkout(self, size, repeat=10):
+    '''Checkout of a cart of size lines'''
+    fill_cart(self, size)
+    url = url_for('cart.checkout', lang=self.language)
+
+    def checkout():
+        response = self.client.post(url, data=self.checkout_data)
+        assert response.status_code in (200, 302)
+    return measure(checkout, repeat=repeat)
+
+
+def bench_confirm(self, size, repeat=5):
+    '''Confirm a cart of size lines (the cart is filled before each sale)'''
+    url = url_for('cart.confirm', lang=self.language)
+
+    def confirm():
+        response = self.client.post(url, data=self.checkout_data)
+        assert response.status_code in (200, 302)
+    return measure(confirm, repeat=repeat, setup=lambda: fill_cart(self, size))
+
+
+def cart_file_content(self, rows):
+    '''CSV cart file of rows lines with the product codes'''
+    content = io.StringIO()
+    content.write('code,quantity\n')
+    codes = self.product_codes
+    for i in range(rows):
+        content.write('%s,1\n' % codes[i % len(codes)])
+    return content.getvalue().encode('utf-8')
+
+
+def bench_cart_file(self, rows, repeat=3):
+    '''Import a CSV cart file of rows lines to an empty cart'''
+    content = cart_file_content(self, rows)
+    url = url_for('cart.cart-file', lang=self.language)
+
+    def cart_file():
+        response = self.client.post(url, data={
+                'cart-file': (io.BytesIO(content), 'cart.csv'),
+                }, content_type='multipart/form-data')
+        assert response.status_code in (200, 202, 302)
+    return measure(cart_file, repeat=repeat, setup=lambda: clear_cart(self))
+
+
+def run_benchmarks(self, sizes=CART_SIZES, file_rows=FILE_ROWS):
+    '''
+    Run all benchmarks. Return {"view:size": measure} with the ratio of
+    the median to the calibration workload.
+    '''
+    sizes = [s for s in sizes if s <= len(self.product_ids)]
+    results = {}
+    for size in sizes:
+        results['add:%s' % size] = bench_add(self, size)
+        results['my_cart:%s' % size] = bench_my_cart(self, size)
+        results['cart_list:%s' % size] = bench_cart_list(self, size)
+        results['checkout:%s' % size] = bench_checkout(self, size)
+        results['confirm:%s' % size] = bench_confirm(self, size)
+    for rows in file_rows:
+        results['cart_file:%s' % rows] = bench_cart_file(self, rows)
+    clear_cart(self)
+    unit = calibrate()
+    for result in results.values():
+        result['ratio'] = round(result['median'] / unit, 3) if unit else None
+    return results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare_baseline(results, baseline, tolerance=0.5, key='ratio'):
+    '''
+    Return the benchmarks slower than the baseline more than tolerance
+    (ratio): [(name, baseline, result)]
+    '''
+    regressions = []
+    for name, result in sorted(results.items()):
+        if not baseline.get(name, {}).get(key) or not result.get(key):
+            continue
+        expected = baseline[name][key]
+        if result[key] > expected * (1 + tolerance):
+            regressions.append((name, expected, result[key]))
+    return regressions
+
+
+def assert_baseline(results, path, tolerance=0.5, update=None):
+    '''
+    Check the results with the baseline saved in path. The baseline is
+    written when it does not exist or update is set (or the environment
+    variable CART_BENCHMARK_UPDATE).
+    '''
+    if update is None:
+        update = bool(os.environ.get('CART_BENCHMARK_UPDATE'))
+    baseline = load_baseline(path)
+    if not baseline or update:
+        save_baseline(path, results)
+        return
+    regressions = compare_baseline(results, baseline, tolerance)
+    assert not regressions, 'Slower than baseline: %s' % ', '.join(
+        '%s %s > %s' % (name, result, expected)
+        for name, expected, result in regressions)
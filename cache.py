@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    '''
+    Memory cache by worker (thread safe).
+
+    Keep at most size_limit keys, dropping the least recently used, and
+    expire the keys after ttl seconds (None to not expire).
+    '''
+    def __init__(self, size_limit=1024, ttl=None):
+        self.size_limit = size_limit
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expire = self._data[key]
+            except KeyError:
+                return default
+            if expire is not None and expire < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expire = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expire)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size_limit:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
@@ -1,11 +1,12 @@
-import csv
-import codecs
-import uuid
+import hashlib
+import os
+import tempfile
+import time
+import click
 from flask import Blueprint, render_template, current_app, abort, g, url_for, \
     flash, redirect, session, request, jsonify
 from galatea.tryton import tryton
 from galatea.csrf import csrf
-from galatea.utils import thumbnail
 from galatea.helpers import login_required, customer_required
 from flask_babel import gettext as _, ngettext
 from flask_login import current_user
@@ -14,16 +15,26 @@ from trytond.exceptions import UserError
 from trytond.modules.sale_stock_quantity.exceptions import StockQuantityError
 from werkzeug.utils import secure_filename
 from .forms import SaleForm, PartyForm, ShipmentAddressForm, InvoiceAddressForm
+from .utils import (get_cart_session, cart_domain, cart_owner, cart_version,
+    forget_cart_merged,
+    get_images, get_carriers, get_default_values,
+    product_code_resolver, summarize_lines, summary_delta, cart_summary_json,
+    load_cart_summary, save_cart_summary, read_cart_lines, summarize_rows,
+    crosssell_index, country_lookup, CARRIER_CACHE_TTL)
+from .cache import LRUCache
+from .locks import lock_cart, CartLockTimeout
+from .profiling import phase, start_timing, server_timing
+from .validation import is_valid_email, is_valid_vat, vat_number
+from .purge import (count_orphan_lines, purge_orphan_lines, PURGE_DAYS,
+    PURGE_BATCH)
+from .stock import PRODUCT_TYPE_STOCK, get_stock_quantities, invalidate_stock
+from .importer import (read_rows, openpyxl, CartFileImport, CartFileError,
+    start_import_job, CartFileJob)
 from decimal import Decimal
-from emailvalid import check_email
-import stdnum.eu.vat as vat
 
 ALLOWED_EXTENSIONS = ['csv']
-try:
-    import openpyxl
+if openpyxl:
     ALLOWED_EXTENSIONS.append('xlsx')
-except:
-    pass
 
 cart = Blueprint('cart', __name__, template_folder='templates')
 
@@ -34,6 +45,10 @@ DELIVERY_INVOICE_ADDRESS = current_app.config.get('TRYTON_SALE_DELIVERY_INVOICE_
 CART_ANONYMOUS = current_app.config.get('TRYTON_CART_ANONYMOUS', True)
 CART_CROSSSELLS = current_app.config.get('TRYTON_CART_CROSSSELLS', True)
 LIMIT_CROSSELLS = current_app.config.get('TRYTON_CATALOG_LIMIT_CROSSSELLS', 10)
+# load the cross sells of the cart page from the crosssells endpoint
+CART_CROSSSELLS_DEFERRED = current_app.config.get('TRYTON_CART_CROSSSELLS_DEFERRED', False)
+CROSSSELLS_CACHE_TTL = current_app.config.get('TRYTON_CART_CROSSSELLS_CACHE_TTL', 300)
+SUBDIVISIONS_MAX_AGE = current_app.config.get('TRYTON_CART_SUBDIVISIONS_MAX_AGE', 3600)
 MINI_CART_CODE = current_app.config.get('TRYTON_CATALOG_MINI_CART_CODE', False)
 SALE_KIT = current_app.config.get('TRYTON_SALE_KIT', False)
 SALE_RULE = current_app.config.get('TRYTON_SALE_RULE', False)
@@ -41,7 +56,14 @@ REDIRECT_TO_PAYMENT_GATEWAY = current_app.config.get('REDIRECT_TO_PAYMENT_GATEWA
 GALATEA_CART_FILE = current_app.config.get('TRYTON_GALATEA_CART_FILE', False)
 GALATEA_CART_FILE_LOGIN = current_app.config.get('TRYTON_GALATEA_CART_FILE_LOGIN', True)
 GALATEA_CART_FILE_FOUND_LIMIT = current_app.config.get('TRYTON_GALATEA_CART_FILE_FOUND_LIMIT')
+GALATEA_CART_FILE_ASYNC = current_app.config.get('TRYTON_GALATEA_CART_FILE_ASYNC', False)
+STOCK_CONFIRM_FRESH = current_app.config.get('TRYTON_CART_STOCK_CONFIRM_FRESH', True)
 SALE_STATE_EXCLUDE = current_app.config.get('TRYTON_SALE_STATE_EXCLUDE', [])
+MINI_CART_CACHE_TTL = current_app.config.get('TRYTON_CART_MINI_CART_CACHE_TTL', 60)
+MINI_CART_CACHE_SIZE = current_app.config.get('TRYTON_CART_MINI_CART_CACHE_SIZE', 4096)
+CART_VALIDATE = current_app.config.get('TRYTON_CART_VALIDATE', False)
+# validations by cart and minute (by worker)
+CART_VALIDATE_RATE_LIMIT = current_app.config.get('TRYTON_CART_VALIDATE_RATE_LIMIT', 30)
 
 Date = tryton.pool.get('ir.date')
 Website = tryton.pool.get('galatea.website')
@@ -56,10 +78,48 @@ Address = tryton.pool.get('party.address')
 Sale = tryton.pool.get('sale.sale')
 SaleLine = tryton.pool.get('sale.line')
 Country = tryton.pool.get('country.country')
-Subdivision = tryton.pool.get('country.subdivision')
 PaymentType = tryton.pool.get('account.payment.type')
 
-PRODUCT_TYPE_STOCK = ['goods', 'assets']
+mini_cart_cache = LRUCache(MINI_CART_CACHE_SIZE, ttl=MINI_CART_CACHE_TTL)
+MINI_CART_FIELDS = ['quantity', 'unit_price', 'unit_price_w_tax', 'amount',
+    'amount_w_tax', 'product.code', 'product.rec_name', 'product.type',
+    'product.template', 'product.template.esale_slug']
+crosssells_cache = LRUCache(1024, ttl=CROSSSELLS_CACHE_TTL)
+validate_calls = LRUCache(4096, ttl=60)
+
+
+@cart.cli.command('purge')
+@click.option('--days', default=PURGE_DAYS, type=int,
+    help='Days without changes of the anonymous cart lines.')
+@click.option('--batch', default=PURGE_BATCH, type=int,
+    help='Lines to delete by transaction.')
+@click.option('--max-batches', default=None, type=int)
+@click.option('--dry-run', is_flag=True, help='Only count the lines.')
+def purge(days, batch, max_batches, dry_run):
+    '''Delete the abandoned cart lines of anonymous sessions'''
+    database = current_app.config['TRYTON_DATABASE']
+    user = current_app.config.get('TRYTON_USER', 0)
+    if dry_run:
+        click.echo('%s lines to delete' % count_orphan_lines(
+                database, user, days=days))
+        return
+
+    def progress(deleted, seconds):
+        click.echo('%s lines deleted (%.0f lines/s)' % (
+                deleted, deleted / seconds if seconds else 0))
+    deleted = purge_orphan_lines(database, user, days=days, batch_size=batch,
+        max_batches=max_batches, progress=progress)
+    click.echo('%s lines deleted' % deleted)
+
+
+@cart.before_request
+def before_request():
+    start_timing()
+
+
+@cart.after_request
+def after_request(response):
+    return server_timing(response)
 
 
 class Cart(object):
@@ -93,8 +153,12 @@ def carriers(lang):
     payment = request.args.get('payment', None)
     customer = session.get('customer', None)
 
-    shop = Shop(SHOP)
-    decimals = "%0."+str(shop.currency.digits)+"f" # "%0.2f" euro
+    cart_session = get_cart_session()
+    config = cart_session.config
+    if not config:
+        abort(404)
+    shop = cart_session.shop
+    decimals = "%0."+str(config.currency_digits)+"f" # "%0.2f" euro
 
     if country is not None:
         try:
@@ -102,7 +166,7 @@ def carriers(lang):
         except ValueError:
             country = None
 
-    carriers = Sale.get_esale_carriers(
+    carriers = get_carriers(
         shop=shop,
         party=Party(customer) if customer else None,
         untaxed=Decimal(untaxed) if untaxed else 0,
@@ -112,78 +176,183 @@ def carriers(lang):
         address_id=int(address_id) if address_id else None,
         postal_code=postal_code,
         country=country,
+        digits=config.currency_digits,
         )
 
-    return jsonify(result=[{
+    response = jsonify(result=[{
         'id': c['carrier'].id,
-        'name': c['carrier'].rec_name,
+        'name': c['name'],
         'price':  float(Decimal(decimals % c['price'])),
         'price_w_tax': float(Decimal(decimals % c['price_w_tax'])),
-        'currency': shop.currency.symbol,
+        'currency': config.currency_symbol,
         } for c in carriers])
+    response.headers['Cache-Control'] = 'private, max-age=%s' % CARRIER_CACHE_TTL
+    response.add_etag()
+    return response.make_conditional(request)
+
+def etag_response(key, result, cache_control='private, no-cache'):
+    '''
+    JSON response of result() with the ETag of key (the values the result
+    depends on). Answer 304, without call result, if the client has it.
+    '''
+    etag = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+    if request.method == 'GET' and etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(result=result())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def mini_cart_key():
+    '''Cache key of the mini cart: it changes when the cart is written'''
+    # the cart version is by session: the session id is in the key, so
+    # sessions of the same user never share an entry or an ETag, and the
+    # time bucket expires the carts written by the other sessions
+    # (without TTL the ETag only changes with the cart version)
+    bucket = (int(time.time() / MINI_CART_CACHE_TTL)
+        if MINI_CART_CACHE_TTL else 0)
+    return (cart_owner(), session.sid, session.get('customer'),
+        cart_version(), g.language, bucket)
 
-@cart.route('/json/my-cart', methods=['GET', 'PUT'], endpoint="my-cart")
 @tryton.transaction()
-def my_cart(lang):
-    '''All Carts JSON'''
+def _my_cart(lang):
     items = []
 
-    shop = Shop(SHOP)
-    domain = [
-        ('sale', '=', None),
-        ('shop', '=', SHOP),
-        ('type', '=', 'line'),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR',
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
+    cart_session = get_cart_session()
+    config = cart_session.config
+    if not config:
+        abort(404)
+    # read only the fields of the mini cart, without browse the lines
+    rows = read_cart_lines(MINI_CART_FIELDS)
 
-    lines = SaleLine.search(domain)
+    images = get_images({r['product.template'] for r in rows
+            if r['product.template']})
 
-    decimals = "%0."+str(shop.currency.digits)+"f" # "%0.2f" euro
-    for line in lines:
-        img = line.product.template.esale_default_images
-        image = current_app.config.get('BASE_IMAGE')
-        if img.get('small'):
-            thumbname = img['small']['name']
-            filename = img['small']['digest']
-            image = thumbnail(filename, thumbname, '200x200')
+    decimals = "%0."+str(config.currency_digits)+"f" # "%0.2f" euro
+    for row in rows:
+        image = images.get(row['product.template'],
+            current_app.config.get('BASE_IMAGE'))
         items.append({
-            'id': line.id,
-            'name': line.product.code if MINI_CART_CODE else line.product.rec_name,
+            'id': row['id'],
+            'name': row['product.code'] if MINI_CART_CODE else row['product.rec_name'],
             'url': url_for('catalog.product_'+g.language, lang=g.language,
-                slug=line.product.template.esale_slug),
-            'quantity': line.quantity,
-            'unit_price': float(Decimal(decimals % line.unit_price)),
-            'unit_price_w_tax': float(Decimal(decimals % line.unit_price_w_tax)),
-            'untaxed_amount': float(Decimal(decimals % line.amount)),
-            'amount_w_tax': float(Decimal(decimals % line.amount_w_tax)),
+                slug=row['product.template.esale_slug']),
+            'quantity': row['quantity'],
+            'unit_price': float(Decimal(decimals % row['unit_price'])),
+            'unit_price_w_tax': float(Decimal(decimals % row['unit_price_w_tax'])),
+            'untaxed_amount': float(Decimal(decimals % row['amount'])),
+            'amount_w_tax': float(Decimal(decimals % row['amount_w_tax'])),
             'image': image,
             })
 
-    return jsonify(result={
-        'currency': shop.currency.symbol,
+    summary = load_cart_summary()
+    if summary is None:
+        summary = summarize_rows(rows)
+        save_cart_summary(summary)
+
+    return {
+        'currency': config.currency_symbol,
         'items': items,
-        })
+        'summary': cart_summary_json(summary),
+        }
+
+@cart.route('/json/my-cart', methods=['GET', 'PUT'], endpoint="my-cart")
+def my_cart(lang):
+    '''All Carts JSON'''
+    key = mini_cart_key()
+
+    def result():
+        result = mini_cart_cache.get(key)
+        if result is None:
+            result = _my_cart(lang)
+            mini_cart_cache.set(key, result)
+        return result
+    # not changed cart: answer without open a tryton transaction
+    return etag_response(key, result)
+
+@cart.route('/json/subdivisions', methods=['GET'], endpoint="subdivisions")
+@tryton.transaction()
+def subdivisions(lang):
+    '''Subdivisions of a country (JSON). Filter by the name or code prefix
+    with q and the number of subdivisions with limit'''
+    country = country_lookup.country(request.args.get('country'))
+    if not country:
+        abort(404)
+    prefix = request.args.get('q')
+    try:
+        # zero or negative: all subdivisions
+        limit = max(int(request.args.get('limit', 0)), 0) or None
+    except ValueError:
+        limit = None
+
+    # same result for all shoppers while the subdivisions not change
+    key = (country.id, prefix, limit, g.language, country_lookup.generation())
+    return etag_response(key, lambda: [{
+                'id': s.id,
+                'code': s.code,
+                'name': s.name,
+                } for s in country_lookup.search_subdivisions(
+                    country.id, prefix, limit)],
+        cache_control='public, max-age=%s' % SUBDIVISIONS_MAX_AGE)
+
+@cart.route('/json/validate', methods=['GET'], endpoint="validate")
+def validate(lang):
+    '''Validate the email and the VAT (JSON), while the user types them'''
+    if not CART_VALIDATE:
+        abort(404)
+    # only sessions with a cart (login users or carts already written)
+    if not session.get('user') and not cart_version():
+        abort(403)
+    # the VAT and email checks could query external services (VIES, DNS)
+    owner = cart_owner()
+    now = time.time()
+    start, calls = validate_calls.get(owner) or (now, 0)
+    if now - start >= 60:
+        start, calls = now, 0
+    if calls >= CART_VALIDATE_RATE_LIMIT:
+        abort(429)
+    validate_calls.set(owner, (start, calls + 1))
+
+    result = {}
+    email = request.args.get('email')
+    if email is not None:
+        result['email'] = is_valid_email(email)
+    vat_country = request.args.get('vat_country')
+    vat_code = request.args.get('vat_code')
+    if vat_country and vat_code:
+        result['vat'] = is_valid_vat(vat_number(vat_country, vat_code))
+    response = jsonify(result=result)
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
+
+@tryton.transaction()
+def _cart_summary(lang):
+    return cart_summary_json(get_cart_session().summary)
+
+@cart.route('/json/cart-summary', methods=['GET'], endpoint="cart-summary")
+def cart_summary(lang):
+    '''Cart totals JSON (lines, quantity, amounts and stockable)'''
+    summary = load_cart_summary()
+    if summary is not None:
+        # not changed cart: answer without open a tryton transaction
+        result = cart_summary_json(summary)
+    else:
+        result = _cart_summary(lang)
+    response = jsonify(result=result)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @cart.route("/confirm/", methods=["POST"], endpoint="confirm")
 @tryton.transaction()
 def confirm(lang):
     '''Confirm and create a sale'''
-    websites = Website.search([
-        ('id', '=', GALATEA_WEBSITE),
-        ], limit=1)
-    if not websites:
+    cart_session = get_cart_session()
+    config = cart_session.config
+    if not config:
         abort(404)
-    website, = websites
 
-    shop = Shop(SHOP)
+    shop = cart_session.shop
     data = request.form
 
     party = session.get('customer')
@@ -198,41 +367,27 @@ def confirm(lang):
     shipment_address = shipment_address if shipment_address != 'None' else None
 
     # Lines
-    domain = [
-        ('sale', '=', None),
-        ('shop', '=', SHOP),
-        ('type', '=', 'line'),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR',
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    lines = SaleLine.search(domain)
+    lines = cart_session.lines
     if not lines:
         flash(_('There are not products in your cart.'), 'danger')
         return redirect(url_for('.cart', lang=g.language))
 
     # Party
     if party:
-        party = Party(party)
+        party = cart_session.party
     else:
         email = data.get('invoice_email') or data.get('shipment_email')
         vat_country = data.get('vat_country', '')
         vat_code = data.get('vat_code', '')
 
-        if not check_email(email):
+        if not is_valid_email(email):
             flash(_('Email "{email}" is not valid.').format(
                 email=email), 'danger')
             return redirect(url_for('.cart', lang=g.language))
 
         if vat_country and vat_code:
-            vat_code = '%s%s' % (vat_country.upper(), vat_code)
-            if not vat.is_valid(vat_code):
+            vat_code = vat_number(vat_country, vat_code)
+            if not is_valid_vat(vat_code):
                 flash(_('We found some errors in your VAT. ' \
                     'Try again or contact us.'), 'danger')
                 return redirect(url_for('.cart', lang=g.language))
@@ -303,21 +458,22 @@ def confirm(lang):
             if kit_lines:
                 lines.extend(kit_lines)
 
-    if website.esale_stock:
+    if config.esale_stock:
+        quantities = get_stock_quantities([l.product for l in lines],
+            config.esale_stock_qty, warehouse=config.warehouse,
+            fresh=STOCK_CONFIRM_FRESH)
         for line in lines:
             # checkout stock available
-            if line.product.type not in PRODUCT_TYPE_STOCK:
+            if line.product.id not in quantities:
                 continue
-            if website.esale_stock_qty == 'forecast_quantity':
-                quantity = line.product.esale_forecast_quantity
-            else:
-                quantity = line.product.esale_quantity
+            quantity = quantities[line.product.id]
             if not (line.quantity > 0 and line.quantity <= quantity):
                 flash(_('Not enought stock for the product "{product}" (maximun: {quantity} units).').format(
                     product=line.product.rec_name, quantity=quantity), 'danger')
                 return redirect(url_for('.cart', lang=g.language))
 
-    sale = form_sale.get_sale(party=party, lines=lines, step='confirm')
+    with phase('get_sale'):
+        sale = form_sale.get_sale(party=party, lines=lines, step='confirm')
     if invoice_address:
         sale.invoice_address = invoice_address
     if shipment_address:
@@ -325,7 +481,8 @@ def confirm(lang):
 
     # Apply rules
     if SALE_RULE:
-        with Transaction().set_context({'apply_rule': False}):
+        with Transaction().set_context({'apply_rule': False}), \
+                phase('rules'):
             sale.coupon = request.form.get('coupon', None)
             rule_lines = sale.apply_rule()
             if rule_lines:
@@ -333,8 +490,9 @@ def confirm(lang):
 
     # prevalidate + save sale
     try:
-        sale.pre_validate()
-        sale.save()
+        with phase('save'):
+            sale.pre_validate()
+            sale.save()
     except UserError as e:
         current_app.logger.info(e)
         return redirect(url_for('.cart', lang=g.language))
@@ -347,8 +505,10 @@ def confirm(lang):
         flash(_('We found some errors when confirm your sale.' \
             'Try again or contact us.'), 'danger')
         return redirect(url_for('.cart', lang=g.language))
+    # cart lines are now lines of the sale
+    cart_session.invalidate()
 
-    with Transaction().set_context(_skip_warnings=True):
+    with Transaction().set_context(_skip_warnings=True), phase('quote'):
         # Convert draft to quotation
         try:
             Sale.quote([sale])
@@ -367,6 +527,9 @@ def confirm(lang):
             flash(_('We found some errors when quote your sale #%s. Contact Us.' % sale.id), 'danger')
             sale_redirect = 'sale.sale' if 'draft' not in SALE_STATE_EXCLUDE else '.cart'
             return redirect(url_for(sale_redirect, lang=g.language))
+    # the quotation has changed the forecast quantities
+    invalidate_stock([l.product.id for l in sale.lines if l.product],
+        warehouse=config.warehouse)
 
     if current_app.debug:
         current_app.logger.info('Sale. Create sale %s' % sale.id)
@@ -384,39 +547,32 @@ def confirm(lang):
 @tryton.transaction()
 def add(lang):
     '''Add product item cart'''
-    websites = Website.search([
-        ('id', '=', GALATEA_WEBSITE),
-        ], limit=1)
-    if not websites:
-        abort(404)
-    website, = websites
-
-    cursor = Transaction().connection.cursor()
-
-    if session.get('customer'):
-        lock_id = ('1%%0%sd' % 7 ) % int(str(session['customer'])[:7])
-    else:
-        lock_id = int('2'+str(uuid.UUID(session.sid).int)[:7])
-
-    cursor.execute("SELECT * FROM pg_try_advisory_xact_lock(%s)", (lock_id,))
-    res = cursor.fetchone()
-    if not res[0]:
+    # wait other add requests of the same cart (before read the cart)
+    try:
+        lock_cart()
+    except CartLockTimeout:
+        message = _('Your cart is being updated. Try again in a few seconds.')
         if request.is_json:
-            return jsonify(result=False, messages={})
-        else:
-            return redirect(url_for('.cart', lang=g.language))
+            return jsonify(result=False, messages={'success': '', 'warning': message})
+        flash(message, 'warning')
+        return redirect(url_for('.cart', lang=g.language))
+
+    cart_session = get_cart_session()
+    config = cart_session.config
+    if not config:
+        abort(404)
 
     to_create = []
     to_update = []
     to_remove = []
-    to_remove_products = [] # Products in older cart and don't sell
 
     # Convert form values to dict values {'id': 'qty'}
     values = {}
-    codes = []
+    codes = set()
+    keys = {} # product id: code requested
+    results = {} # code or product id requested: (qty, status)
 
-    default_line = SaleLine.default_get(SaleLine._fields.keys(),
-            with_rec_name=False)
+    default_line = get_default_values(SaleLine)
 
     # json request
     if request.is_json:
@@ -437,7 +593,7 @@ def add(lang):
                     values[int(prod[1])] = qty
                 except ValueError:
                     values[prod[1]] = qty
-                    codes.append(prod[1])
+                    codes.add(prod[1])
 
         if not values:
             return jsonify(result=False)
@@ -461,56 +617,45 @@ def add(lang):
                     values[int(prod[1])] = qty
                 except ValueError:
                     values[prod[1]] = qty
-                    codes.append(prod[1])
+                    codes.add(prod[1])
 
     # transform product code to id
     if codes:
-        products = Product.search([
-            ('code', 'in', codes),
-            ('salable', '=', True),
-            ])
+        products_by_code = product_code_resolver.resolve(codes)
         # reset dict
         vals = values.copy()
         values = {}
 
         for k, v in vals.items():
-            for prod in products:
-                if prod.code == k:
-                    values[prod.id] = v
-                    break
+            product_id = (products_by_code.get(
+                    product_code_resolver.normalize(k))
+                if k in codes else k)
+            if product_id:
+                values[product_id] = v
+                keys[product_id] = k
+            else:
+                results[k] = (v, 'not_found')
 
     # Remove items in cart
     removes = request.form.getlist('remove')
 
     # Search current cart by user or session
-    domain = [
-        ('sale', '=', None),
-        ('shop', '=', SHOP),
-        ('type', '=', 'line'),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR',
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    lines = SaleLine.search(domain)
-
-    party = None
-    if session.get('customer'):
-        party = Party(session.get('customer'))
+    lines = cart_session.lines
+    party = cart_session.party
 
     form_sale = current_app.extensions['Cart'].sale_form()
-    sale = form_sale.get_sale(party=party, step='add')
+    with phase('get_sale'):
+        sale = form_sale.get_sale(party=party, step='add')
 
-    # Products Current Cart (products available in sale.cart)
-    products_in_cart = [l.product.id for l in lines]
+    # Index current cart lines by id and product (first line of each product)
+    lines_by_id = {}
+    lines_by_product = {}
+    for line in lines:
+        lines_by_id[line.id] = line
+        lines_by_product.setdefault(line.product.id, line)
 
     domain = [
-        ('id', 'in', [k for k, _ in values.items()]),
+        ('id', 'in', list(values.keys())),
         ('template.esale_available', '=', True),
         ('template.esale_active', '=', True),
         ('template.shops', 'in', [SHOP]),
@@ -521,105 +666,121 @@ def add(lang):
     products_by_id = dict((p.id, p) for p in Product.search(domain))
 
     # Delete products data
-    if removes:
-        for remove in removes:
-            for line in lines:
-                try:
-                    if line.id == int(remove):
-                        to_remove.append(line)
-                        break
-                except:
-                    flash(_('You try to remove no numeric cart. ' \
-                        'The request has been stopped.'))
-                    return redirect(url_for('.cart', lang=g.language))
+    for remove in removes:
+        try:
+            line = lines_by_id.get(int(remove))
+        except ValueError:
+            flash(_('You try to remove no numeric cart. ' \
+                'The request has been stopped.'))
+            return redirect(url_for('.cart', lang=g.language))
+        if line:
+            to_remove.append(line)
+
+    # Stock of the products to add
+    quantities = {}
+    if config.esale_stock:
+        quantities = get_stock_quantities(products_by_id.values(),
+            config.esale_stock_qty, warehouse=config.warehouse)
 
     # Add/Update products data
-    for product_id, qty in values.items():
-        product = products_by_id.get(product_id)
-        if not product or not product.add_cart:
-            continue
-
-        # Add cart if have stock
-        if website.esale_stock:
-            if website.esale_stock_qty == 'forecast_quantity':
-                quantity = product.esale_forecast_quantity
-            else:
-                quantity = product.esale_quantity
-            if product.type in PRODUCT_TYPE_STOCK and not (quantity > 0 and qty <= quantity):
-                flash(_('Not enough stock for the product "{product}" (maximun: {quantity} units).').format(
-                    product=product.rec_name, quantity=quantity), 'danger')
+    with Transaction().set_context(cart_session.price_context):
+        for product_id, qty in values.items():
+            key = keys.get(product_id, product_id)
+            product = products_by_id.get(product_id)
+            if not product or not product.add_cart:
+                results[key] = (qty, 'not_available')
                 continue
 
-        context = {}
-        context['customer'] = session.get('customer', None)
-        if party and getattr(party, 'sale_price_list'):
-            context['price_list'] = party.sale_price_list.id if party.sale_price_list else None
-        with Transaction().set_context(context):
+            # Add cart if have stock
+            if product.id in quantities:
+                quantity = quantities[product.id]
+                if not (quantity > 0 and qty <= quantity):
+                    flash(_('Not enough stock for the product "{product}" (maximun: {quantity} units).').format(
+                        product=product.rec_name, quantity=quantity), 'danger')
+                    results[key] = (qty, 'no_stock')
+                    continue
+
             products_to_add = dict()
             if SALE_KIT and product.kit and not product.kit_fixed_list_price:
-                kit_lines = list(product.kit_lines)
-                while kit_lines:
-                    kit_line = kit_lines.pop(0)
+                for kit_line in product.kit_lines:
                     products_to_add[kit_line.product.id] = kit_line.quantity * qty
             else:
                 products_to_add[product.id] = qty
 
+            status = None
             # update or delete lines
-            for line in lines:
-                if line.product.id in products_to_add:
-                    quantity = products_to_add[line.product.id]
-                    # allow show update message in case qty == line.quantity
-                    if (quantity == line.quantity) or (quantity > 0):
-                        line.quantity = quantity
-                        line.on_change_quantity()
-                        try:
-                            line.pre_validate()
-                            to_update.extend(([line], line._save_values))
-                        except UserError as e:
-                            flash(e.message, 'danger')
-                    else:
-                        # Remove data when qty <= 0
-                        to_remove.append(line)
-                    del products_to_add[line.product.id]
+            for line_product_id in list(products_to_add.keys()):
+                line = lines_by_product.get(line_product_id)
+                if not line:
+                    continue
+                quantity = products_to_add.pop(line_product_id)
+                # allow show update message in case qty == line.quantity
+                if (quantity == line.quantity) or (quantity > 0):
+                    line.quantity = quantity
+                    line.on_change_quantity()
+                    try:
+                        line.pre_validate()
+                        to_update.extend(([line], line._save_values))
+                        status = 'updated'
+                    except UserError as e:
+                        flash(e.message, 'danger')
+                        status = 'error'
+                else:
+                    # Remove data when qty <= 0
+                    to_remove.append(line)
+                    status = 'deleted'
 
             # create lines
-            for product_id, quantity in products_to_add.items():
+            for line_product_id, quantity in products_to_add.items():
+                if product.id in lines_by_product or quantity <= 0:
+                    continue
                 line = SaleLine(**default_line)
                 line.sale = sale
                 line.party = party
                 line.quantity = quantity
-                line.product = product_id
+                line.product = line_product_id
                 line.shop = SHOP
                 if session.get('user', None):
                     line.galatea_user = session['user']
                 else:
                     line.sid = session.sid
+                    forget_cart_merged()
                 line.on_change_product()
 
                 # Create data
-                if product.id not in products_in_cart and quantity > 0:
-                    line.on_change_quantity()
-                    # set sale to none
-                    line.sale = None
-                    try:
-                        line.pre_validate()
-                        to_create.append(line._save_values)
-                    except UserError as e:
-                        flash(e.message, 'danger')
-
-    # Add to remove older products
-    if to_remove_products:
-        for remove in to_remove_products:
-            for line in lines:
-                if line.product.id == remove:
-                    to_remove.append(line)
-                    break
+                line.on_change_quantity()
+                # set sale to none
+                line.sale = None
+                try:
+                    line.pre_validate()
+                    to_create.append(line._save_values)
+                    status = status or 'created'
+                except UserError as e:
+                    flash(e.message, 'danger')
+                    status = 'error'
+            results[key] = (qty, status)
+
+    # a line removed from the cart page is also posted with its quantity:
+    # delete it and do not write it
+    to_remove = list(dict((l.id, l) for l in to_remove).values())
+    removed_ids = [l.id for l in to_remove]
+    lines_values = []
+    for records, values in zip(to_update[::2], to_update[1::2]):
+        if records[0].id not in removed_ids:
+            lines_values.extend((records, values))
+    to_update = lines_values
+
+    # Totals of the lines to write, to update the cart summary
+    updated_ids = [l.id for records in to_update[::2] for l in records]
+    before = summarize_lines(SaleLine.browse(
+            updated_ids + removed_ids))
+    created = []
 
     # Add Cart
     if to_create:
         # compatibility sale kit
-        with Transaction().set_context(explode_kit=False):
-            SaleLine.create(to_create)
+        with Transaction().set_context(explode_kit=False), phase('save'):
+            created = SaleLine.create(to_create)
         flash(ngettext(
             '%(num)s product has been added in your cart.',
             '%(num)s products have been added in your cart.',
@@ -628,24 +789,27 @@ def add(lang):
     # Update Cart
     if to_update:
         # compatibility sale kit
-        with Transaction().set_context(explode_kit=False):
+        with Transaction().set_context(explode_kit=False), phase('save'):
             SaleLine.write(*to_update)
-        total = len(to_update)/2
-        if to_remove:
-            total = total-len(to_remove)
         flash(ngettext(
             '%(num)s product has been updated in your cart.',
             '%(num)s products have been updated in your cart.',
-            int(total)), 'success')
+            len(to_update) // 2), 'success')
 
     # Delete Cart
     if to_remove:
-        SaleLine.delete(to_remove)
+        with phase('save'):
+            SaleLine.delete(to_remove)
         flash(ngettext(
             '%(num)s product has been deleted in your cart.',
             '%(num)s products have been deleted in your cart.',
             len(to_remove)), 'success')
 
+    if to_create or to_update or to_remove:
+        after = summarize_lines(SaleLine.browse(
+                [l.id for l in created] + updated_ids))
+        cart_session.invalidate(summary_delta(before, after))
+
     if request.is_json:
         # Add JSON messages (success, warning)
         success = []
@@ -660,7 +824,11 @@ def add(lang):
         messages['warning'] = ",".join(warning)
 
         session.pop('_flashes', None)
-        return jsonify(result=True, messages=messages)
+        return jsonify(result=True, messages=messages, items=[{
+            'product': key,
+            'quantity': qty,
+            'status': status,
+            } for key, (qty, status) in results.items()])
     else:
         return redirect(url_for('.cart', lang=g.language))
 
@@ -668,34 +836,19 @@ def add(lang):
 @tryton.transaction()
 def checkout(lang):
     '''Checkout sale'''
-    websites = Website.search([
-        ('id', '=', GALATEA_WEBSITE),
-        ], limit=1)
-    if not websites:
+    cart_session = get_cart_session()
+    config = cart_session.config
+    if not config:
         abort(404)
-    website, = websites
+    website = Website(config.website)
 
     errors = []
-    shop = Shop(SHOP)
-    countries = [(c.id, c.name) for c in shop.esale_countrys]
+    shop = cart_session.shop
+    countries = list(config.esale_countrys)
 
     email = request.form.get('invoice_email') or request.form.get('shipment_email')
 
-    domain = [
-        ('sale', '=', None),
-        ('shop', '=', SHOP),
-        ('type', '=', 'line'),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR',
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    lines = SaleLine.search(domain)
+    lines = cart_session.lines
     if not lines:
         flash(_('There are not products in your cart.'), 'danger')
         return redirect(url_for('.cart', lang=g.language))
@@ -714,11 +867,10 @@ def checkout(lang):
     form_sale = current_app.extensions['Cart'].sale_form()
     form_sale.load()
 
-    party = None
-    if session.get('customer'):
-        party = Party(session.get('customer'))
+    party = cart_session.party
 
-    sale = form_sale.get_sale(party=party, lines=lines, step='checkout')
+    with phase('get_sale'):
+        sale = form_sale.get_sale(party=party, lines=lines, step='checkout')
 
     if party:
         if session.get('b2b') or hasattr(Party, 'party_sale_payer'):
@@ -729,15 +881,14 @@ def checkout(lang):
         flash(_('Please login in to continue the checkout.'), 'danger')
         return redirect(url_for('.cart', lang=g.language))
 
-    if website.esale_stock:
+    if config.esale_stock:
+        quantities = get_stock_quantities([l.product for l in lines],
+            config.esale_stock_qty, warehouse=config.warehouse)
         for line in lines:
             # checkout stock available
-            if line.product.type not in PRODUCT_TYPE_STOCK:
+            if line.product.id not in quantities:
                 continue
-            if website.esale_stock_qty == 'forecast_quantity':
-                quantity = line.product.esale_forecast_quantity
-            else:
-                quantity = line.product.esale_quantity
+            quantity = quantities[line.product.id]
             if not (line.quantity > 0 and line.quantity <= quantity):
                 flash(_('Not enought stock for the product "{product}" (maximun: {quantity} units).').format(
                     product=line.product.rec_name, quantity=quantity), 'danger')
@@ -751,8 +902,8 @@ def checkout(lang):
     vat_country = form_party.vat_country.data
     vat_code = form_party.vat_code.data
     if vat_country and vat_code:
-        vat_code = '%s%s' % (vat_country.upper(), vat_code)
-        if not vat.is_valid(vat_code):
+        vat_code = vat_number(vat_country, vat_code)
+        if not is_valid_vat(vat_code):
             flash(_('We found some errors in your VAT. ' \
                 'Try again or contact us.'), 'danger')
             return redirect(url_for('.cart', lang=g.language))
@@ -769,22 +920,21 @@ def checkout(lang):
         invoice_email = None
         if request.form.get('invoice_email'):
             invoice_email = request.form.get('invoice_email')
-            if not check_email(invoice_email):
+            if not is_valid_email(invoice_email):
                 errors.append(_('Email not valid.'))
         elif session.get('email'):
             invoice_email = session['email']
         if invoice_email:
             form_invoice_address.invoice_email.data = invoice_email
 
-        invoice_country = request.form.get('invoice_country')
-        if invoice_country:
-            country = Country(invoice_country)
+        country = country_lookup.country(request.form.get('invoice_country'))
+        if country:
             form_invoice_address.invoice_country.choices = [(country.id, country.name)]
             form_invoice_address.invoice_country.data = country.id
 
-        invoice_subdivision = request.form.get('invoice_subdivision')
-        if invoice_subdivision and invoice_subdivision != '0':
-            subdivision = Subdivision(invoice_subdivision)
+        subdivision = country_lookup.subdivision(
+            request.form.get('invoice_subdivision'))
+        if subdivision:
             form_invoice_address.invoice_subdivision.label = subdivision.name
             form_invoice_address.invoice_subdivision.data = subdivision.id
     elif party:
@@ -837,7 +987,7 @@ def checkout(lang):
         shipment_email = None
         if request.form.get('shipment_email'):
             shipment_email = request.form.get('shipment_email')
-            if not check_email(shipment_email):
+            if not is_valid_email(shipment_email):
                 errors.append(_('Email not valid.'))
         elif session.get('email'):
             shipment_email = session['email']
@@ -883,12 +1033,15 @@ def checkout(lang):
 
     # Apply rules
     if SALE_RULE:
-        with Transaction().set_context({'apply_rule': False}):
+        with Transaction().set_context({'apply_rule': False}), \
+                phase('rules'):
             coupon = request.form.get('coupon', None)
             form_sale.coupon.default = coupon
             sale.coupon = coupon
             rule_lines = sale.apply_rule()
-            sale.lines += tuple(rule_lines,)
+            if rule_lines:
+                sale.lines += tuple(rule_lines,)
+            # rules could change the existing lines too
             sale.on_change_lines()
 
     if request.form.get('carrier'):
@@ -907,48 +1060,34 @@ def checkout(lang):
         'name': _('Checkout'),
         }]
 
-    return render_template('checkout.html',
-            website=website,
-            breadcrumbs=breadcrumbs,
-            shop=shop,
-            sale=sale,
-            errors=errors,
-            form_sale=form_sale,
-            form_party=form_party,
-            form_invoice_address=form_invoice_address,
-            form_shipment_address=form_shipment_address,
-            )
+    with phase('render'):
+        return render_template('checkout.html',
+                website=website,
+                breadcrumbs=breadcrumbs,
+                shop=shop,
+                sale=sale,
+                errors=errors,
+                form_sale=form_sale,
+                form_party=form_party,
+                form_invoice_address=form_invoice_address,
+                form_shipment_address=form_shipment_address,
+                )
 
 @cart.route("/", endpoint="cart")
 @tryton.transaction()
 def cart_list(lang):
     '''Cart by user or session'''
-    websites = Website.search([
-        ('id', '=', GALATEA_WEBSITE),
-        ], limit=1)
-    if not websites:
+    cart_session = get_cart_session()
+    config = cart_session.config
+    if not config:
         abort(404)
-    website, = websites
+    website = Website(config.website)
 
-    shop = Shop(SHOP)
-    countries = [(str(c.id), c.name) for c in shop.esale_countrys]
+    shop = cart_session.shop
+    countries = [(str(id_), name) for id_, name in config.esale_countrys]
 
     # Products and lines
-    domain = [
-        ('sale', '=', None),
-        ('shop', '=', SHOP),
-        ('type', '=', 'line'),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR',
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    lines = SaleLine.search(domain)
+    lines = cart_session.lines
 
     # Party and Addresses
     party = None
@@ -963,7 +1102,7 @@ def cart_list(lang):
         user = GalateaUser(session['user'])
 
         if session.get('customer'):
-            party = Party(session['customer'])
+            party = cart_session.party
             for address in party.addresses:
                 addresses.append(address)
                 if address.invoice and user.display_invoice_address:
@@ -988,28 +1127,23 @@ def cart_list(lang):
     payment_types, default_payment_type = shop.get_esale_payments(party)
 
     # Carriers
-    stockable = Carrier.get_products_stockable([l.product.id for l in lines])
+    stockable = Carrier.get_products_stockable(
+        [p.id for p in cart_session.products])
     carriers = []
     default_carrier = None
     if stockable:
-        untaxed_amount = Decimal(0)
-        tax_amount = Decimal(0)
-        total_amount = Decimal(0)
-        for line in lines:
-            untaxed_amount += line.amount
-            tax_amount += line.amount_w_tax - line.amount
-            total_amount += line.amount_w_tax
-
-        carriers = Sale.get_esale_carriers(
+        summary = cart_session.summary
+        carriers = get_carriers(
             shop=shop,
             party=party,
-            untaxed=untaxed_amount,
-            tax=tax_amount,
-            total=total_amount,
+            untaxed=summary['untaxed'],
+            tax=summary['tax'],
+            total=summary['total'],
             payment=default_payment_type,
             address_id=default_shipment_address,
             postal_code=default_shipment_address.postal_code if default_shipment_address else None,
             country=default_shipment_address.country if default_shipment_address else None,
+            digits=config.currency_digits,
             )
         if party and hasattr(party, 'carrier'):
             if party.carrier:
@@ -1031,7 +1165,7 @@ def cart_list(lang):
     shipment_address_choices.append(('new-address', _('New address')))
 
     form_party = current_app.extensions['Cart'].party_form(
-        vat_country=shop.esale_country.code,
+        vat_country=config.esale_country_code,
         invoice_address=str(default_invoice_address.id) if default_invoice_address else invoice_address_choices[0][0],
         shipment_address=str(default_shipment_address.id) if default_shipment_address else shipment_address_choices[0][0],
         )
@@ -1041,13 +1175,14 @@ def cart_list(lang):
 
     # Invoice address country options
     form_invoice_address = current_app.extensions['Cart'].invoice_address_form(
-        invoice_country=str(shop.esale_country.id) if shop.esale_country else None)
+        invoice_country=(str(config.esale_country)
+            if config.esale_country else None))
     form_invoice_address.invoice_country.choices = countries
     form_invoice_address.load()
 
     # Shipment address country options
     form_shipment_address = current_app.extensions['Cart'].shipment_address_form(
-        shipment_country=shop.esale_country.id if shop.esale_country else None)
+        shipment_country=config.esale_country)
     form_shipment_address.shipment_country.choices = countries
     form_shipment_address.load()
 
@@ -1060,12 +1195,13 @@ def cart_list(lang):
 
     # Carrier options
     form_sale.carrier.choices = [
-        (c['carrier'].id, c['carrier'].rec_name) for c in carriers]
+        (c['carrier'].id, c['name']) for c in carriers]
     if default_carrier:
         form_sale.carrier.default = default_carrier.id
 
     # Create a demo sale
-    sale = form_sale.get_sale(party=party, step='list')
+    with phase('get_sale'):
+        sale = form_sale.get_sale(party=party, step='list')
     if session.get('b2b') or hasattr(Party, 'party_sale_payer'):
         sale.party = party
         sale.shipment_party = party
@@ -1081,16 +1217,19 @@ def cart_list(lang):
 
     # Cross Sells
     crossells = []
-    if CART_CROSSSELLS:
-        template_ids = list({l.product.template.id for l in lines})
-        templates = Template.browse(template_ids)
-        crossells_ids = set()
-        for template in templates:
-            for crossell in template.esale_crosssells_by_shop:
-                crossells_ids.add(crossell.id)
+    crossells_url = None
+    if CART_CROSSSELLS and CART_CROSSSELLS_DEFERRED:
+        crossells_url = url_for('.crosssells', lang=g.language)
+    elif CART_CROSSSELLS:
+        crossells_ids = crosssell_index.select(
+            [t.id for t in cart_session.templates], limit=LIMIT_CROSSELLS)
         if crossells_ids:
             with Transaction().set_context(without_special_price=True):
-                crossells = Template.browse(list(crossells_ids)[:LIMIT_CROSSELLS])
+                crossells = Template.browse(crossells_ids)
+
+    # Images (thumbnails) of the cart lines and cross sells
+    images = get_images({t.id for t in cart_session.templates}
+        | {t.id for t in crossells})
 
     session['next'] = url_for('.cart', lang=g.language)
 
@@ -1100,20 +1239,56 @@ def cart_list(lang):
         'name': _('Cart'),
         }]
 
-    return render_template('cart.html',
-            website=website,
-            breadcrumbs=breadcrumbs,
-            shop=shop,
-            form_sale=form_sale,
-            form_party=form_party,
-            form_invoice_address=form_invoice_address,
-            form_shipment_address=form_shipment_address,
-            party=party,
-            user=user,
-            sale=sale,
-            crossells=crossells,
-            stockable=stockable,
-            )
+    with phase('render'):
+        return render_template('cart.html',
+                website=website,
+                breadcrumbs=breadcrumbs,
+                shop=shop,
+                form_sale=form_sale,
+                form_party=form_party,
+                form_invoice_address=form_invoice_address,
+                form_shipment_address=form_shipment_address,
+                party=party,
+                user=user,
+                sale=sale,
+                crossells=crossells,
+                crossells_url=crossells_url,
+                images=images,
+                stockable=stockable,
+                )
+
+@cart.route('/json/crosssells', methods=['GET'], endpoint="crosssells")
+@tryton.transaction()
+def crosssells(lang):
+    '''Cross sells of the cart (JSON)'''
+    if not CART_CROSSSELLS:
+        abort(404)
+    cart_session = get_cart_session()
+    template_ids = tuple(sorted(t.id for t in cart_session.templates))
+
+    # cross sells only change with the templates of the cart (and prices
+    # with the customer). Only data is cached, not rendered HTML.
+    key = (template_ids, session.get('customer'), g.language)
+
+    def result():
+        result = crosssells_cache.get(key)
+        if result is None:
+            crossells_ids = crosssell_index.select(template_ids,
+                limit=LIMIT_CROSSELLS)
+            with Transaction().set_context(without_special_price=True):
+                crossells = Template.browse(crossells_ids)
+                images = get_images(crossells_ids)
+                result = [{
+                    'id': t.id,
+                    'name': t.rec_name,
+                    'url': url_for('catalog.product_'+g.language,
+                        lang=g.language, slug=t.esale_slug),
+                    'image': images.get(t.id),
+                    } for t in crossells]
+            crosssells_cache.set(key, result)
+        return result
+    # the url is the same when the cart changes: revalidate with the ETag
+    return etag_response(key, result)
 
 @cart.route("/pending", endpoint="cart-pending")
 @login_required
@@ -1172,43 +1347,21 @@ def clone(lang):
         products.add(l.product.id)
 
     # Search current carts by user or session
-    domain = [
-        ('sale', '=', None),
-        ('shop', '=', SHOP),
-        ('type', '=', 'line'),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR',
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    lines = SaleLine.search(domain)
+    cart_session = get_cart_session()
 
     # remove products that exist in current cart
-    for l in lines:
-        if l.product.id in products:
-            products.remove(l.product.id)
+    for p in cart_session.products:
+        products.discard(p.id)
 
-    party = None
-    if session.get('customer'):
-        party = Party(session.get('customer'))
-
-    context = {}
-    context['customer'] = session.get('customer', None)
-    if party and getattr(party, 'sale_price_list'):
-        context['price_list'] = party.sale_price_list.id if party.sale_price_list else None
-    elif shop.price_list:
+    context = cart_session.price_context
+    if 'price_list' not in context and shop.price_list:
         context['price_list'] = shop.price_list.id
 
+    forget_cart_merged()
     with Transaction().set_context(context):
         to_create = []
         for product_id in products:
-            defaults = SaleLine.default_get(SaleLine._fields.keys(), with_rec_name=False)
-            line = SaleLine(**defaults)
+            line = SaleLine(**get_default_values(SaleLine))
             line.shop = shop
             line.party = sale.party.id
             line.sid = session.sid
@@ -1219,7 +1372,8 @@ def clone(lang):
             to_create.append(line._save_values)
 
     if to_create:
-        SaleLine.create(to_create)
+        lines = SaleLine.create(to_create)
+        cart_session.invalidate(summary_delta(after=summarize_lines(lines)))
         flash(ngettext(
             '%(num)s product has been added in your cart.',
             '%(num)s products have been added in your cart.',
@@ -1248,172 +1402,128 @@ def cart_file(lang):
         flash(_('No selected file'))
         return redirect(url_for('.cart', lang=g.language))
 
-    flines = {}
-    to_create = []
-    to_update = []
     extension = allowed_file(file.filename)
 
     if file and extension:
         filename = secure_filename(file.filename)
 
-        # CSV
-        if extension == 'csv':
-            try:
-                stream = codecs.iterdecode(file.stream, 'utf-8')
-                rows = csv.reader(stream, dialect=csv.excel)
-                next(rows)
-            except:
-                flash(_('Error reading "{filename}" file.').format(
-                    filename=filename), 'danger')
-                return redirect(url_for('.cart', lang=g.language))
-            for row in rows:
-                try:
-                    code = str(row[0])
-                    quantity = float(row[1])
-                    if flines.get(code):
-                        flines[code] += quantity
-                    else:
-                        flines[code] = quantity
-                except (ValueError, TypeError):
-                    flash(_('Error reading format cells in the "{filename}" file.').format(
-                        filename=filename), 'danger')
-                    return redirect(url_for('.cart', lang=g.language))
-        # XLS
-        elif extension == 'xlsx':
-            try:
-                wb = openpyxl.load_workbook(file)
-                sheet = wb.active
-            except:
-                flash(_('Error reading "{filename}" file.').format(
-                    filename=filename), 'danger')
-                return redirect(url_for('.cart', lang=g.language))
-            for row in sheet.iter_rows(values_only=True, min_row=2):
-                try:
-                    code = str(row[0])
-                    quantity = float(row[1])
-                    if flines.get(code):
-                        flines[code] += quantity
-                    else:
-                        flines[code] = quantity
-                except (ValueError, TypeError):
-                    flash(_('Error reading format cells in the "{filename}" file.').format(
-                        filename=filename), 'danger')
-                    return redirect(url_for('.cart', lang=g.language))
-
-        # Search current cart by user or session
-        domain = [
-            ('sale', '=', None),
-            ('shop', '=', SHOP),
-            ('type', '=', 'line'),
-            ('product', '!=', None),
-            ]
-        if session.get('user'): # login user
-            domain.append(['OR',
-                ('sid', '=', session.sid),
-                ('galatea_user', '=', session['user']),
-                ])
-        else: # anonymous user
-            domain.append(
-                ('sid', '=', session.sid),
+        cart_session = get_cart_session()
+        forget_cart_merged()
+        if GALATEA_CART_FILE_ASYNC:
+            # import the file in background from a temporary copy
+            fd, path = tempfile.mkstemp(suffix='.%s' % extension)
+            with os.fdopen(fd, 'wb') as tmp:
+                file.save(tmp)
+            job = start_import_job(path, extension,
+                owner=cart_owner(),
+                filename=filename,
+                domain=cart_domain(),
+                shop=SHOP,
+                sid=session.sid,
+                user=session.get('user', None),
+                customer=session.get('customer', None),
+                price_context=cart_session.price_context,
+                not_found_limit=GALATEA_CART_FILE_FOUND_LIMIT,
                 )
-        lines = dict((l.product.code, l) for l in SaleLine.search(domain))
-
-        codes = [k for k, v in flines.items()]
-        codes_upper = [c.upper() for c in codes]
-        codes += codes_upper
-        codes += [c.lower() for c in codes]
-        codes = set(codes)
-
-        domain = [('salable', '=', True)]
-        if hasattr(Product, 'customer_code'):
-            domain.append(['OR',
-                        ('customer_code', 'in', codes),
-                        ('code', 'in', codes)])
-        else:
-            domain.append(('code', 'in', codes))
+            status = url_for('.cart-file-status', lang=g.language, job=job.id)
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify(job=job.id, status=status), 202
+            flash(_('The file "{filename}" is being imported in your cart.').format(
+                filename=filename), 'success')
+            return redirect(url_for('.cart', lang=g.language))
 
-        products = Product.search(domain)
-        products_by_code = dict((p.code.upper(), p) for p in products)
-        if hasattr(Product, 'customer_code'):
-            products_by_code.update(dict((p.customer_code.upper(), p) for p in products if p.customer_code))
+        try:
+            rows = read_rows(file.stream, extension)
+        except:
+            flash(_('Error reading "{filename}" file.').format(
+                filename=filename), 'danger')
+            return redirect(url_for('.cart', lang=g.language))
+
+        cart_import = CartFileImport(
+            domain=cart_domain(),
+            shop=SHOP,
+            sid=session.sid,
+            user=session.get('user', None),
+            customer=session.get('customer', None),
+            price_context=cart_session.price_context,
+            not_found_limit=GALATEA_CART_FILE_FOUND_LIMIT,
+            )
+        try:
+            cart_import.run(rows)
+        except CartFileError:
+            # not keep the lines of the previous chunks
+            Transaction().rollback()
+            flash(_('Error reading format cells in the "{filename}" file.').format(
+                filename=filename), 'danger')
+            return redirect(url_for('.cart', lang=g.language))
 
         # check products by code/customer_code
-        not_found = []
-        if len(codes_upper) != len(products_by_code):
-            for code in codes_upper:
-                if not products_by_code.get(code):
-                    not_found.append(code)
-                if (GALATEA_CART_FILE_FOUND_LIMIT
-                        and len(not_found) > GALATEA_CART_FILE_FOUND_LIMIT):
-                    not_found.append('...')
-                    break
+        if cart_import.not_found:
+            not_found = list(cart_import.not_found)
+            if cart_import.not_found_count > len(not_found):
+                not_found.append('...')
             flash(_('Can not found "{not_found}" products in the "{filename}" file.').format(
                 not_found= ', '.join(not_found), filename=filename), 'danger')
+        for error in cart_import.errors:
+            flash(error, 'danger')
 
-        party = None
-        if session.get('customer'):
-            party = Party(session.get('customer'))
-
-        context = {}
-        context['customer'] = session.get('customer', None)
-        if party and getattr(party, 'sale_price_list'):
-            context['price_list'] = party.sale_price_list.id if party.sale_price_list else None
-        with Transaction().set_context(context):
-            for code, qty in flines.items():
-                code = code.upper()
-                product = products_by_code.get(code)
-                if not product:
-                    continue
-
-                if lines.get(code):
-                    line = lines.get(code)
-                    line.quantity = round(qty, product.sale_uom.digits)
-                    line.on_change_quantity()
-                    try:
-                        line.pre_validate()
-                        to_update.extend(([line], line._save_values))
-                    except UserError as e:
-                        flash(e.message, 'danger')
-                        continue
-                else:
-                    line = SaleLine()
-                    defaults = line.default_get(line._fields.keys(), with_rec_name=False)
-                    for key in defaults:
-                        setattr(line, key, defaults[key])
-                    line.party = session.get('customer', None)
-                    line.unit = product.sale_uom
-                    line.quantity = round(qty, product.sale_uom.digits)
-                    line.product = product
-                    line.sid = session.sid
-                    line.shop = SHOP
-                    line.galatea_user = session.get('user', None)
-                    line.on_change_product()
-                    line.on_change_quantity()
-                    try:
-                        line.pre_validate()
-                        to_create.append(line._save_values)
-                    except UserError as e:
-                        flash(e.message, 'danger')
-                        continue
-
-        if to_create:
-            # compatibility sale kit
-            with Transaction().set_context(explode_kit=False):
-                SaleLine.create(to_create)
+        if cart_import.created:
             flash(ngettext(
                 '%(num)s product has been added in your cart.',
                 '%(num)s products have been added in your cart.',
-                len(to_create)), 'success')
-        if to_update:
-            # compatibility sale kit
-            with Transaction().set_context(explode_kit=False):
-                SaleLine.write(*to_update)
-            total = len(to_update)/2
+                cart_import.created), 'success')
+        if cart_import.updated:
             flash(ngettext(
                 '%(num)s product has been updated in your cart.',
                 '%(num)s products have been updated in your cart.',
-                int(total)), 'success')
+                cart_import.updated), 'success')
+        if cart_import.created or cart_import.updated:
+            cart_session.invalidate(cart_import.delta)
     else:
         flash(_('Can not import selected file'))
 
     return redirect(url_for('.cart', lang=g.language))
+
+@cart.route("/cart-file/<job>", methods=["GET"], endpoint="cart-file-status")
+def cart_file_status(lang, job):
+    '''Status of a cart file import in background (JSON)'''
+    if not GALATEA_CART_FILE:
+        abort(404)
+    cart_job = CartFileJob.load(job)
+    if not cart_job or cart_job.owner != CartFileJob.owner_key(cart_owner()):
+        abort(404)
+
+    # the job could be polled from any worker: the jobs already notified
+    # are kept in the session
+    notified = session.get('cart_file_notified') or []
+    if cart_job.state == 'done' and cart_job.id not in notified:
+        # the mini cart and the summary of this session have changed
+        get_cart_session().invalidate(cart_job.delta)
+        session['cart_file_notified'] = (notified + [cart_job.id])[-10:]
+
+    error = None
+    if cart_job.error == 'read':
+        error = _('Error reading "{filename}" file.').format(
+            filename=cart_job.filename)
+    elif cart_job.error == 'format':
+        error = _('Error reading format cells in the "{filename}" file.').format(
+            filename=cart_job.filename)
+    elif cart_job.error == 'locked':
+        error = _('Your cart is being updated. Try again in a few seconds.')
+    elif cart_job.error:
+        error = _('We found some errors when import the "{filename}" file. '
+            'Try again or contact us.').format(filename=cart_job.filename)
+
+    return jsonify(result={
+        'id': cart_job.id,
+        'state': cart_job.state,
+        'filename': cart_job.filename,
+        'rows': cart_job.rows,
+        'created': cart_job.created,
+        'updated': cart_job.updated,
+        'not_found': cart_job.not_found,
+        'not_found_count': cart_job.not_found_count,
+        'errors': cart_job.errors,
+        'error': error,
+        'error_row': cart_job.error_row,
+        })
@@ -7,16 +7,16 @@ from flask_wtf import FlaskForm as Form
 from wtforms import (IntegerField, TextAreaField, StringField, SelectField,
         RadioField, validators)
 from trytond.transaction import Transaction
+from .utils import (get_cart_session, get_default_values, country_lookup,
+    summarize_lines)
+from .validation import is_valid_email, is_valid_vat, vat_number
 
 Party = tryton.pool.get('party.party')
 Address = tryton.pool.get('party.address')
-Country = tryton.pool.get('country.country')
-Subdivision = tryton.pool.get('country.subdivision')
 Sale = tryton.pool.get('sale.sale')
 PaymentType = tryton.pool.get('account.payment.type')
 Date = tryton.pool.get('ir.date')
 Carrier = tryton.pool.get('carrier')
-Shop = tryton.pool.get('sale.shop')
 
 SHOP = current_app.config.get('TRYTON_SALE_SHOP')
 
@@ -56,10 +56,8 @@ class SaleForm(Form):
             self.carrier.default = request.form.get('carrier')
 
     def get_sale(self, party=None, lines=[], step=None):
-        shop = Shop(SHOP)
-        default_values = Sale.default_get(Sale._fields.keys(),
-            with_rec_name=False)
-        sale = Sale(**default_values)
+        shop = get_cart_session().shop
+        sale = Sale(**get_default_values(Sale))
         sale.esale = True
         sale.on_change_shop()
         sale.warehouse = shop.warehouse
@@ -89,28 +87,33 @@ class SaleForm(Form):
             sale.comment = comment
         sale.galatea_user = session.get('user')
 
-        sale.lines = lines
-        # not set sale in lines because when confirm could be loop recursion (save)
-        if request.endpoint != 'cart.confirm':
-            for line in sale.lines:
-                line.sale = sale
-
         # Carrier
+        carrier = None
         if request.form.get('carrier'):
-            # add shipment line
             carrier_id = request.form.get('carrier')
             carrier = Carrier(carrier_id)
             sale.shipment_cost_method = Sale.default_shipment_cost_method() or 'order'
             sale.carrier = carrier
-            sale.on_change_lines()
-
-            # calculate shipment price
+            # sale values to calculate the shipment price, before set the
+            # lines so they are not serialized
             sale_vals = sale._save_values
-            sale_vals['untaxed_amount'] = sale.untaxed_amount
-            sale_vals['total_amount'] = sale.total_amount
             if 'lines' in sale_vals:
                 del sale_vals['lines']
 
+        sale.lines = lines
+        # not set sale in lines because when confirm could be loop recursion (save)
+        if request.endpoint != 'cart.confirm':
+            for line in sale.lines:
+                line.sale = sale
+
+        if carrier:
+            # totals of the product lines (the amounts of the lines, as the
+            # cart summary) to calculate the shipment price
+            summary = summarize_lines(sale.lines)
+            sale_vals['untaxed_amount'] = summary['untaxed']
+            sale_vals['tax_amount'] = summary['tax']
+            sale_vals['total_amount'] = summary['total']
+
             context = {}
             context['record'] = sale_vals
             context['record_model'] = 'sale.sale'
@@ -118,6 +121,7 @@ class SaleForm(Form):
             with Transaction().set_context(context):
                 carrier_price = carrier.get_sale_price() # return price, currency
 
+            # add shipment line
             shipment_price = carrier_price[0] or Decimal('0.0')
             shipment_line = sale.get_shipment_cost_line(sale.carrier, shipment_price)
             shipment_line.unit_price_w_tax = shipment_line.on_change_with_unit_price_w_tax()
@@ -128,7 +132,7 @@ class SaleForm(Form):
         extra_lines = sale._get_extra_lines()
         if extra_lines:
             sale.lines += tuple(extra_lines)
-
+        # the only calculation of the sale amounts, with all lines
         sale.on_change_lines()
         return sale
 
@@ -149,6 +153,14 @@ class PartyForm(Form):
         rv = Form.validate(self)
         if not rv:
             return False
+        if not is_valid_email(self.esale_email.data):
+            self.esale_email.errors.append(lazy_gettext('Email not valid.'))
+            return False
+        if self.vat_country.data and self.vat_code.data:
+            if not is_valid_vat(vat_number(self.vat_country.data,
+                        self.vat_code.data)):
+                self.vat_code.errors.append(lazy_gettext('VAT not valid.'))
+                return False
         return True
 
     def load(self):
@@ -221,17 +233,16 @@ class ShipmentAddressForm(Form):
                 self.shipment_subdivision.label = ''
                 self.shipment_subdivision.data = 0
         else:
-            shipment_country = request.form.get('%s_country' % type_)
-            if shipment_country:
-                country = Country(shipment_country)
+            country = country_lookup.country(request.form.get('%s_country' % type_))
+            if country:
                 self.shipment_country.choices = [(country.id, country.name)]
                 self.shipment_country.data = country.id
 
-            shipment_subdivision = request.form.get('%s_subdivision' % type_)
-            if shipment_subdivision and shipment_subdivision != '0':
-                subdivision = Subdivision(shipment_subdivision)
+            subdivision = country_lookup.subdivision(
+                request.form.get('%s_subdivision' % type_))
+            if subdivision:
                 self.shipment_subdivision.label = subdivision.name
-                self.shipment_subdivision.data = shipment_subdivision
+                self.shipment_subdivision.data = subdivision.id
             else:
                 self.shipment_subdivision.label = ''
                 self.shipment_subdivision.data = 0
@@ -298,17 +309,16 @@ class InvoiceAddressForm(Form):
                 self.invoice_subdivision.label = ''
                 self.invoice_subdivision.data = 0
         else:
-            invoice_country = request.form.get('invoice_country')
-            if invoice_country:
-                country = Country(invoice_country)
+            country = country_lookup.country(request.form.get('invoice_country'))
+            if country:
                 self.invoice_country.choices = [(country.id, country.name)]
                 self.invoice_country.data = country.id
 
-            invoice_subdivision = request.form.get('invoice_subdivision')
-            if invoice_subdivision and invoice_subdivision != '0':
-                subdivision = Subdivision(invoice_subdivision)
+            subdivision = country_lookup.subdivision(
+                request.form.get('invoice_subdivision'))
+            if subdivision:
                 self.invoice_subdivision.label = subdivision.name
-                self.invoice_subdivision.data = invoice_subdivision
+                self.invoice_subdivision.data = subdivision.id
             else:
                 self.invoice_subdivision.label = ''
                 self.invoice_subdivision.data = 0
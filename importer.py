@@ -0,0 +1,409 @@
+import csv
+import codecs
+import hashlib
+import json
+import os
+import re
+import stat
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from itertools import islice
+from threading import Lock
+from flask import current_app
+from galatea.tryton import tryton
+from trytond.exceptions import UserError
+from trytond.transaction import Transaction
+from .locks import lock_cart, CartLockTimeout
+from .utils import (get_default_values, product_code_resolver,
+    summarize_lines, summary_delta, add_summary_delta)
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+CART_FILE_CHUNK = current_app.config.get('TRYTON_GALATEA_CART_FILE_CHUNK', 500)
+CART_FILE_WORKERS = current_app.config.get('TRYTON_GALATEA_CART_FILE_WORKERS', 2)
+# seconds to keep the status of the import jobs
+CART_FILE_JOB_TTL = current_app.config.get('TRYTON_GALATEA_CART_FILE_JOB_TTL', 3600)
+# directory of the status of the import jobs, shared by all the workers
+# (private: created 0700 and owned by the user of the workers)
+CART_FILE_JOB_DIR = current_app.config.get('TRYTON_GALATEA_CART_FILE_JOB_DIR',
+    os.path.join(tempfile.gettempdir(), 'galatea-cart-jobs'))
+
+JOB_ID = re.compile('^[0-9a-f]{32}$')
+
+Product = tryton.pool.get('product.product')
+SaleLine = tryton.pool.get('sale.line')
+
+
+class CartFileError(Exception):
+    '''Wrong row format in a cart file'''
+    def __init__(self, row):
+        super(CartFileError, self).__init__(row)
+        self.row = row
+
+
+def read_rows(file, extension):
+    '''
+    Open a CSV or XLSX cart file and return an iterator of the rows
+    (code, quantity), without the header row. The file is read while
+    iterating, so memory does not depend on the file size.
+    '''
+    if extension == 'csv':
+        stream = codecs.iterdecode(file, 'utf-8')
+        rows = csv.reader(stream, dialect=csv.excel)
+        next(rows)
+        return _parse_rows(rows)
+    elif extension == 'xlsx':
+        wb = openpyxl.load_workbook(file, read_only=True)
+        rows = wb.active.iter_rows(values_only=True, min_row=2)
+        return _parse_rows(rows, close=wb.close)
+    raise ValueError(extension)
+
+
+def _parse_rows(rows, close=None):
+    number = 1
+    try:
+        while True:
+            number += 1
+            try:
+                row = next(rows)
+            except StopIteration:
+                break
+            except (csv.Error, UnicodeDecodeError):
+                raise CartFileError(number)
+            try:
+                yield str(row[0]), float(row[1])
+            except (ValueError, TypeError, IndexError):
+                raise CartFileError(number)
+    finally:
+        if close:
+            close()
+
+
+def iter_chunks(rows, size):
+    '''
+    Lists of size rows of an iterator, reading the rows of one chunk at a
+    time (grouped_slice could call len() or read all the rows)
+    '''
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+class CartFileImport(object):
+    '''
+    Add the rows of a cart file to a cart.
+
+    Rows are processed in chunks of chunk_size rows: the codes of the chunk
+    are resolved and its lines created or written before reading the next
+    chunk. Only the ids of the cart lines are kept between chunks.
+    Quantities of a product repeated in the file are summed.
+    '''
+    def __init__(self, domain, shop, sid=None, user=None, customer=None,
+            price_context=None, chunk_size=CART_FILE_CHUNK,
+            not_found_limit=None, progress=None):
+        self.domain = domain
+        self.shop = shop
+        self.sid = sid
+        self.user = user
+        self.customer = customer
+        self.price_context = price_context or {}
+        self.chunk_size = chunk_size
+        self.not_found_limit = not_found_limit
+        self.progress = progress
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.not_found = []
+        self.not_found_count = 0
+        self.errors = []
+        # change of the cart summary (see summary_delta)
+        self.delta = None
+
+    def run(self, rows):
+        # product id: line id of the current cart
+        self._lines = dict((l.product.id, l.id) for l in SaleLine.search(
+                self.domain + [('product', '!=', None)]))
+        # product id: quantity imported
+        self._imported = {}
+        for chunk in iter_chunks(rows, self.chunk_size):
+            quantities = {}
+            for code, quantity in chunk:
+                self.rows += 1
+                code = product_code_resolver.normalize(code)
+                quantities[code] = quantities.get(code, 0) + quantity
+            self._import(quantities)
+            if self.progress:
+                self.progress(self)
+        return self
+
+    def _import(self, quantities):
+        product_ids = product_code_resolver.resolve(quantities.keys(),
+            customer_code=True)
+        for code in quantities:
+            if code not in product_ids:
+                self.not_found_count += 1
+                if (not self.not_found_limit
+                        or len(self.not_found) < self.not_found_limit):
+                    self.not_found.append(code)
+
+        # sum the quantities by product (code and customer code)
+        product_quantities = {}
+        for code, product_id in product_ids.items():
+            product_quantities[product_id] = (
+                product_quantities.get(product_id, 0) + quantities[code])
+
+        products = Product.browse(list(product_quantities.keys()))
+        lines = dict((l.product.id, l) for l in SaleLine.browse(
+                [self._lines[p.id] for p in products if p.id in self._lines]))
+
+        to_create = []
+        to_update = []
+        updated = 0
+        with Transaction().set_context(self.price_context):
+            for product in products:
+                # products of previous chunks are already counted
+                imported = product.id in self._imported
+                qty = (product_quantities[product.id]
+                    + self._imported.get(product.id, 0))
+                self._imported[product.id] = qty
+
+                line = lines.get(product.id)
+                if line:
+                    line.quantity = round(qty, product.sale_uom.digits)
+                    line.on_change_quantity()
+                    try:
+                        line.pre_validate()
+                        to_update.extend(([line], line._save_values))
+                        if not imported:
+                            updated += 1
+                    except UserError as e:
+                        self.errors.append(e.message)
+                        continue
+                else:
+                    line = SaleLine(**get_default_values(SaleLine))
+                    line.party = self.customer
+                    line.unit = product.sale_uom
+                    line.quantity = round(qty, product.sale_uom.digits)
+                    line.product = product
+                    line.sid = self.sid
+                    line.shop = self.shop
+                    line.galatea_user = self.user
+                    line.on_change_product()
+                    line.on_change_quantity()
+                    try:
+                        line.pre_validate()
+                        to_create.append(line._save_values)
+                    except UserError as e:
+                        self.errors.append(e.message)
+                        continue
+
+        updated_ids = [l.id for records in to_update[::2] for l in records]
+        before = summarize_lines(SaleLine.browse(updated_ids))
+        created = []
+        # compatibility sale kit
+        with Transaction().set_context(explode_kit=False):
+            if to_create:
+                created = SaleLine.create(to_create)
+                for line in created:
+                    self._lines[line.product.id] = line.id
+                self.created += len(to_create)
+            if to_update:
+                SaleLine.write(*to_update)
+                self.updated += updated
+        after = summarize_lines(SaleLine.browse(
+                [l.id for l in created] + updated_ids))
+        self.delta = add_summary_delta(self.delta,
+            summary_delta(before, after))
+
+
+class CartFileJob(object):
+    '''
+    Status of a cart file import running in background.
+
+    It is saved as a JSON file in CART_FILE_JOB_DIR, so all the workers of
+    the application (in the same host or sharing the directory) can read
+    the status of the jobs of the others. The owner of the cart is saved
+    as a hash (see owner_key), never the session id.
+    '''
+    _fields = ('id', 'owner', 'filename', 'state', 'rows', 'created',
+        'updated', 'not_found', 'not_found_count', 'errors', 'delta', 'error',
+        'error_row')
+
+    def __init__(self, owner, filename):
+        self.id = uuid.uuid4().hex
+        self.owner = self.owner_key(owner)
+        self.filename = filename
+        self.state = 'pending' # pending, running, done, error
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.not_found = []
+        self.not_found_count = 0
+        self.errors = []
+        self.delta = None
+        self.error = None # read, format, locked or exception
+        self.error_row = None
+
+    def update(self, cart_import):
+        self.rows = cart_import.rows
+        self.created = cart_import.created
+        self.updated = cart_import.updated
+        self.not_found = list(cart_import.not_found)
+        self.not_found_count = cart_import.not_found_count
+        self.errors = list(cart_import.errors)
+        self.delta = cart_import.delta
+
+    def progress(self, cart_import):
+        self.update(cart_import)
+        self.save()
+
+    @staticmethod
+    def owner_key(owner):
+        '''Hash of the cart owner (cart_owner)'''
+        return hashlib.sha256(('%s:%s' % tuple(owner)).encode('utf-8')
+            ).hexdigest()
+
+    @staticmethod
+    def _directory():
+        '''Create (0700) and check the private directory of the jobs'''
+        os.makedirs(CART_FILE_JOB_DIR, mode=0o700, exist_ok=True)
+        info = os.lstat(CART_FILE_JOB_DIR)
+        if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+                or info.st_mode & 0o077):
+            raise PermissionError('Cart file job directory %s must be a '
+                'directory of the user with 0700 permissions'
+                % CART_FILE_JOB_DIR)
+        return CART_FILE_JOB_DIR
+
+    @classmethod
+    def _path(cls, job_id):
+        return os.path.join(cls._directory(), '%s.json' % job_id)
+
+    def save(self):
+        values = dict((f, getattr(self, f)) for f in self._fields)
+        if self.delta is not None:
+            # amounts are Decimal
+            values['delta'] = dict((k, str(v)) for k, v in self.delta.items())
+        path = self._path(self.id)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(values, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, job_id):
+        '''Return the job (None if not found or expired)'''
+        if not JOB_ID.match(job_id or ''):
+            return
+        path = cls._path(job_id)
+        try:
+            if os.path.getmtime(path) + CART_FILE_JOB_TTL < time.time():
+                os.remove(path)
+                return
+            with open(path) as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            return
+        job = cls.__new__(cls)
+        for field in cls._fields:
+            setattr(job, field, values.get(field))
+        if job.delta is not None:
+            job.delta = dict((k, Decimal(v) if k in ('untaxed', 'tax', 'total')
+                    else float(v) if k == 'quantity' else int(v))
+                for k, v in job.delta.items())
+        return job
+
+    @classmethod
+    def purge(cls):
+        '''Remove the files of the expired jobs'''
+        directory = cls._directory()
+        expired = time.time() - CART_FILE_JOB_TTL
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+_executor = None
+_executor_lock = Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CART_FILE_WORKERS,
+                thread_name_prefix='cart-file')
+        return _executor
+
+
+def start_import_job(path, extension, owner, filename, **kwargs):
+    '''
+    Import the cart file saved in path in a worker thread, in its own Tryton
+    transaction (database, user and context of the current transaction).
+    The file is removed when the import ends. Return the CartFileJob.
+    '''
+    transaction = Transaction()
+    CartFileJob.purge()
+    job = CartFileJob(owner, filename)
+    job.save()
+    _get_executor().submit(_run_import_job, current_app._get_current_object(),
+        job, owner, transaction.database.name, transaction.user,
+        dict(transaction.context), path, extension, kwargs)
+    return job
+
+
+def _run_import_job(app, job, owner, database, user, context, path, extension,
+        kwargs):
+    with app.app_context():
+        job.state = 'running'
+        job.save()
+        try:
+            with Transaction().start(database, user, readonly=False,
+                    context=context) as transaction:
+                # not write the cart at the same time than add
+                try:
+                    lock_cart(owner)
+                except CartLockTimeout:
+                    job.error = 'locked'
+                    raise
+                with open(path, 'rb') as file:
+                    try:
+                        rows = read_rows(file, extension)
+                    except Exception:
+                        job.error = 'read'
+                        raise
+                    cart_import = CartFileImport(progress=job.progress,
+                        **kwargs)
+                    cart_import.run(rows)
+                transaction.commit()
+        except CartFileError as e:
+            job.error = 'format'
+            job.error_row = e.row
+            job.state = 'error'
+        except Exception:
+            app.logger.exception('Cart file import %s' % job.id)
+            job.error = job.error or 'exception'
+            job.state = 'error'
+        else:
+            job.update(cart_import)
+            job.state = 'done'
+        finally:
+            job.save()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
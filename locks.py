@@ -0,0 +1,117 @@
+import hashlib
+import time
+from threading import Lock
+from flask import current_app, g
+from trytond import backend
+from trytond.transaction import Transaction
+from .utils import cart_owner
+
+# seconds to wait the lock of a cart before give up
+CART_LOCK_TIMEOUT = current_app.config.get('TRYTON_CART_LOCK_TIMEOUT', 5)
+CART_LOCK_POLL = 0.02
+CART_LOCK_POLL_MAX = 0.25
+
+# high 32 bits of the lock keys of the carts of galatea users ("CART")
+LOCK_NAMESPACE = 0x43415254
+
+_stats = {
+    'acquired': 0,
+    'contended': 0,
+    'timeouts': 0,
+    'wait': 0.0,
+    }
+_stats_lock = Lock()
+
+
+class CartLockTimeout(Exception):
+    '''The cart is locked by another request more than the lock timeout'''
+
+
+def _count(key, value=1):
+    with _stats_lock:
+        _stats[key] += value
+
+
+def lock_stats():
+    '''Counters of the cart locks of this worker'''
+    with _stats_lock:
+        return dict(_stats)
+
+
+def cart_lock_key(owner=None):
+    '''
+    Advisory lock key (signed 64 bits) of a cart owner.
+    Galatea users are LOCK_NAMESPACE and the user id, without collisions;
+    sessions are a 64 bits hash of the session id, outside LOCK_NAMESPACE.
+    '''
+    kind, value = owner or cart_owner()
+    if kind == 'user':
+        key = (LOCK_NAMESPACE << 32) | (int(value) & 0xffffffff)
+    else:
+        digest = hashlib.blake2b(str(value).encode('utf-8'),
+            digest_size=8).digest()
+        key = int.from_bytes(digest, 'big')
+        if key >> 32 == LOCK_NAMESPACE:
+            key ^= 1 << 63
+    if key >= 1 << 63:
+        key -= 1 << 64
+    return key
+
+
+def lock_cart(owner=None, timeout=None):
+    '''
+    Lock the cart of the current transaction until it ends.
+
+    Call it before any other query of the transaction. It waits, with a
+    growing poll interval, the lock held by other requests of the same cart
+    up to timeout seconds and raises CartLockTimeout. When the lock is
+    acquired after waiting, the transaction snapshot is older than the
+    commit of the other request: the transaction is rolled back (it has
+    not done anything else) and the lock is taken again with a new
+    snapshot, so concurrent requests are applied one after the other on
+    the current cart instead of rejected.
+    '''
+    if backend.name != 'postgresql':
+        return
+    if timeout is None:
+        timeout = CART_LOCK_TIMEOUT
+    key = cart_lock_key(owner)
+
+    start = time.time()
+    poll = CART_LOCK_POLL
+    waited = False
+    # lock of the current request, logged with the timings
+    request_lock = g.cart_lock = {'wait': 0.0, 'contended': 0,
+        'timeout': False}
+    while True:
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', (key,))
+        if cursor.fetchone()[0]:
+            if not waited:
+                break
+            # restart with a new snapshot (it releases the lock)
+            _count('contended')
+            request_lock['contended'] += 1
+            Transaction().rollback()
+            waited = False
+            continue
+        if time.time() - start >= timeout:
+            _count('timeouts')
+            _count('wait', time.time() - start)
+            request_lock['wait'] = time.time() - start
+            request_lock['timeout'] = True
+            current_app.logger.warning('Cart lock %s timeout (%s)' % (
+                    key, lock_stats()))
+            raise CartLockTimeout(key)
+        waited = True
+        time.sleep(poll)
+        poll = min(poll * 2, CART_LOCK_POLL_MAX)
+
+    _count('acquired')
+    if poll != CART_LOCK_POLL:
+        _count('wait', time.time() - start)
+        request_lock['wait'] = time.time() - start
+        current_app.logger.debug('Cart lock %s acquired after %.3fs (%s)' % (
+                key, time.time() - start, lock_stats()))
+        # the cart read before the restart is not valid
+        g.pop('cart_session', None)
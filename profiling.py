@@ -0,0 +1,211 @@
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock
+from flask import current_app, g, request, has_app_context
+from trytond import backend
+
+# add the Server-Timing header to the cart responses (debug by default)
+SERVER_TIMING = current_app.config.get('TRYTON_CART_SERVER_TIMING',
+    current_app.debug)
+# log the phases of each cart request
+TIMING_LOG = current_app.config.get('TRYTON_CART_TIMING_LOG', False)
+# count the SQL queries and the ORM reads and searches of each cart request
+QUERY_COUNT = current_app.config.get('TRYTON_CART_QUERY_COUNT', False)
+
+# logger of the SQL queries of trytond (LoggingCursor, DEBUG level)
+SQL_LOGGER = 'trytond.backend.postgresql.database'
+# backends where the SQL queries are counted (PostgreSQL by the logger,
+# SQLite by the trace callback of the connections)
+SQL_COUNT_BACKENDS = ('postgresql', 'sqlite')
+COUNTERS = ('sql', 'read', 'search')
+
+
+def start_timing():
+    '''Start the timing of the current request (before_request)'''
+    g.cart_timing_start = time.perf_counter()
+    g.cart_timings = {}
+    g.cart_counts = dict.fromkeys(COUNTERS, 0)
+    g.cart_phase_counts = {}
+
+
+@contextmanager
+def phase(name):
+    '''
+    Time a phase of the current request. Phases with the same name are
+    added (a phase could be run more than once in a request).
+    '''
+    counts = g.get('cart_counts')
+    start_counts = dict(counts) if counts is not None else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('cart_timings', {})
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+        if start_counts is not None:
+            phase_counts = g.cart_phase_counts.setdefault(name,
+                dict.fromkeys(COUNTERS, 0))
+            for key in COUNTERS:
+                phase_counts[key] += counts[key] - start_counts[key]
+
+
+def set_cart_size(size):
+    '''Number of lines of the cart, logged with the phases'''
+    g.cart_size = size
+
+
+def get_timings():
+    '''Phases of the current request {name: seconds}'''
+    return dict(g.get('cart_timings') or {})
+
+
+def get_counts():
+    '''SQL queries and ORM calls of the current request {counter: number}'''
+    return dict(g.get('cart_counts') or {})
+
+
+def count(key):
+    if has_app_context():
+        counts = g.get('cart_counts')
+        if counts is not None:
+            counts[key] += 1
+
+
+class QueryCountHandler(logging.Handler):
+    '''Count the SQL queries logged by the trytond cursor'''
+    def emit(self, record):
+        count('sql')
+
+
+def _trace_sql(statement):
+    count('sql')
+
+
+def _trace_connections(get_connection):
+    @functools.wraps(get_connection)
+    def wrapper(self, *args, **kwargs):
+        connection = get_connection(self, *args, **kwargs)
+        connection.set_trace_callback(_trace_sql)
+        return connection
+    return wrapper
+
+
+def _count_calls(method, key):
+    func = method.__func__
+
+    @functools.wraps(func)
+    def wrapper(cls, *args, **kwargs):
+        count(key)
+        return func(cls, *args, **kwargs)
+    return classmethod(wrapper)
+
+
+_counting = False
+_counting_lock = Lock()
+
+
+def enable_query_count():
+    '''
+    Start to count the SQL queries and the ORM reads and searches.
+    With PostgreSQL the trytond SQL logger is set to DEBUG, so the queries
+    are logged to the handlers that accept DEBUG records. With SQLite the
+    statements are counted by the trace callback of the connections.
+    Other backends only count the reads and searches.
+    '''
+    global _counting
+    from trytond.model import ModelSQL
+    with _counting_lock:
+        if _counting:
+            return
+        if backend.name == 'postgresql':
+            logger = logging.getLogger(SQL_LOGGER)
+            logger.addHandler(QueryCountHandler(logging.DEBUG))
+            logger.setLevel(logging.DEBUG)
+        elif backend.name == 'sqlite':
+            from trytond.backend.sqlite.database import Database
+            Database.get_connection = _trace_connections(
+                Database.get_connection)
+        ModelSQL.read = _count_calls(ModelSQL.read, 'read')
+        ModelSQL.search = _count_calls(ModelSQL.search, 'search')
+        _counting = True
+
+
+if QUERY_COUNT:
+    enable_query_count()
+
+_budgets = []
+
+
+@contextmanager
+def query_budget(**limits):
+    '''
+    Check the queries of each cart request in the block (tests):
+
+        with query_budget(sql=40, read=10):
+            client.get(url_for('cart.my-cart', lang='en'))
+
+    Yields the list of the counts of the requests. A sql budget fails
+    with the backends where the SQL queries are not counted.
+    '''
+    assert 'sql' not in limits or backend.name in SQL_COUNT_BACKENDS, (
+        'SQL queries are not counted with the %s backend' % backend.name)
+    enable_query_count()
+    counts = []
+    _budgets.append(counts)
+    try:
+        yield counts
+    finally:
+        _budgets.remove(counts)
+    for request_counts in counts:
+        for key, limit in limits.items():
+            assert request_counts[key] <= limit, (
+                '%s: %s %s queries (budget %s)' % (request_counts['endpoint'],
+                    request_counts[key], key, limit))
+
+
+def server_timing(response):
+    '''Add the phases to the response (after_request)'''
+    timings = g.get('cart_timings')
+    start = g.get('cart_timing_start')
+    if timings is None or start is None:
+        return response
+    total = time.perf_counter() - start
+    counts = g.get('cart_counts') if _counting else None
+
+    if SERVER_TIMING:
+        metrics = ['%s;dur=%.1f' % (name, value * 1000)
+            for name, value in timings.items()]
+        metrics.append('total;dur=%.1f' % (total * 1000))
+        response.headers.add('Server-Timing', ', '.join(metrics))
+
+    if counts is not None:
+        current_app.logger.debug('Cart queries %s: %s %s' % (
+                request.endpoint,
+                ' '.join('%s=%s' % (k, counts[k]) for k in COUNTERS),
+                g.cart_phase_counts))
+        for budget in list(_budgets):
+            budget.append(dict(counts, endpoint=request.endpoint))
+
+    if TIMING_LOG:
+        record = {
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'cart_size': g.get('cart_size'),
+            'total': round(total * 1000, 1),
+            'phases': dict((name, round(value * 1000, 1))
+                for name, value in timings.items()),
+            }
+        if counts is not None:
+            record['queries'] = dict(counts)
+            record['phase_queries'] = dict(g.cart_phase_counts)
+        if g.get('cart_lock') is not None:
+            from .locks import lock_stats
+            # lock of the request and contention counters of the worker
+            record['lock'] = dict(g.cart_lock,
+                wait=round(g.cart_lock['wait'] * 1000, 1))
+            record['locks'] = lock_stats()
+        current_app.logger.info('Cart timing %(endpoint)s %(total)sms' % record,
+            extra={'cart_timing': record})
+    return response
@@ -0,0 +1,66 @@
+import datetime
+import time
+from flask import current_app
+from galatea.tryton import tryton
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+from trytond.transaction import Transaction
+
+# days without changes to delete the anonymous cart lines
+PURGE_DAYS = current_app.config.get('TRYTON_CART_PURGE_DAYS', 30)
+PURGE_BATCH = current_app.config.get('TRYTON_CART_PURGE_BATCH', 1000)
+
+SaleLine = tryton.pool.get('sale.line')
+
+
+def _orphan_lines(table, cutoff):
+    '''Where of the anonymous cart lines not changed since cutoff'''
+    return ((table.sale == None)
+        & (table.galatea_user == None)
+        & (table.sid != None)
+        & (Coalesce(table.write_date, table.create_date) < cutoff))
+
+
+def count_orphan_lines(database, user=0, days=PURGE_DAYS):
+    '''Number of the anonymous cart lines to purge'''
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    with Transaction().start(database, user, readonly=True):
+        cursor = Transaction().connection.cursor()
+        table = SaleLine.__table__()
+        cursor.execute(*table.select(Count(table.id),
+                where=_orphan_lines(table, cutoff)))
+        return cursor.fetchone()[0]
+
+
+def purge_orphan_lines(database, user=0, days=PURGE_DAYS,
+        batch_size=PURGE_BATCH, max_batches=None, progress=None):
+    '''
+    Delete the cart lines of sessions (without sale and galatea user) not
+    changed in days, batch_size lines by transaction. The lines are deleted
+    with SQL: the anonymous carts have no related records.
+    progress is called after each batch with the deleted lines and the
+    seconds elapsed. Return the number of deleted lines.
+    '''
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    deleted = 0
+    batches = 0
+    start = time.time()
+    while not max_batches or batches < max_batches:
+        with Transaction().start(database, user,
+                readonly=False) as transaction:
+            cursor = transaction.connection.cursor()
+            table = SaleLine.__table__()
+            cursor.execute(*table.select(table.id,
+                    where=_orphan_lines(table, cutoff),
+                    limit=batch_size))
+            ids = [r[0] for r in cursor.fetchall()]
+            if ids:
+                cursor.execute(*table.delete(where=table.id.in_(ids)))
+            transaction.commit()
+        deleted += len(ids)
+        batches += 1
+        if progress:
+            progress(deleted, time.time() - start)
+        if len(ids) < batch_size:
+            break
+    return deleted
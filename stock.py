@@ -0,0 +1,64 @@
+from flask import current_app
+from galatea.tryton import tryton
+from .cache import LRUCache
+from .profiling import phase
+
+# seconds to keep the stock quantities (0 to not cache them)
+STOCK_CACHE_TTL = current_app.config.get('TRYTON_CART_STOCK_CACHE_TTL', 5)
+STOCK_CACHE_SIZE = current_app.config.get('TRYTON_CART_STOCK_CACHE_SIZE', 10000)
+
+Product = tryton.pool.get('product.product')
+
+PRODUCT_TYPE_STOCK = ['goods', 'assets']
+
+stock_cache = LRUCache(STOCK_CACHE_SIZE, ttl=STOCK_CACHE_TTL)
+
+
+def stock_field(quantity='quantity'):
+    '''Product field of the website stock quantity (esale_stock_qty)'''
+    if quantity == 'forecast_quantity':
+        return 'esale_forecast_quantity'
+    return 'esale_quantity'
+
+
+def get_stock_quantities(products, quantity='quantity', warehouse=None,
+        fresh=False):
+    '''
+    Return the available quantity of the stockable products
+    {product id: quantity}, computed for all products in one read.
+    quantity is the website esale_stock_qty: quantity or forecast_quantity.
+
+    Quantities are cached STOCK_CACHE_TTL seconds by product, warehouse and
+    quantity; use fresh to read them again.
+    '''
+    product_ids = list({p.id for p in products
+            if p.type in PRODUCT_TYPE_STOCK})
+    field = stock_field(quantity)
+    fresh = fresh or not STOCK_CACHE_TTL
+
+    quantities = {}
+    to_read = []
+    for product_id in product_ids:
+        value = None
+        if not fresh:
+            value = stock_cache.get((product_id, warehouse, field))
+        if value is None:
+            to_read.append(product_id)
+        else:
+            quantities[product_id] = value
+    if to_read:
+        with phase('stock'):
+            records = Product.read(to_read, [field])
+        for values in records:
+            quantities[values['id']] = values[field]
+            if STOCK_CACHE_TTL:
+                stock_cache.set((values['id'], warehouse, field),
+                    values[field])
+    return quantities
+
+
+def invalidate_stock(product_ids, warehouse=None):
+    '''Remove the cached quantities of the products (after move stock)'''
+    for product_id in product_ids:
+        for field in ('esale_quantity', 'esale_forecast_quantity'):
+            stock_cache.delete((product_id, warehouse, field))
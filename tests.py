@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import io
 from flask import url_for
+from . import benchmarks
 
 def add_cart(self):
     '''Add cart'''
@@ -7,3 +9,24 @@ def add_cart(self):
     response = self.client.post(url_for('cart.add', lang=self.language),
         data=self.products, follow_redirects=True)
     assert 'been added in your cart' in str(response.data)
+
+def cart_file_chunks(self, rows=1200):
+    '''Import a cart file of more rows than a chunk'''
+    # product_codes: codes of salable products; rows > TRYTON_GALATEA_CART_FILE_CHUNK
+    content = io.StringIO()
+    content.write('code,quantity\n')
+    for i in range(rows):
+        content.write('%s,1\n' % self.product_codes[i % len(self.product_codes)])
+    response = self.client.post(url_for('cart.cart-file', lang=self.language),
+        data={
+            'cart-file': (io.BytesIO(content.getvalue().encode('utf-8')),
+                'cart.csv'),
+            }, content_type='multipart/form-data', follow_redirects=True)
+    assert 'Error reading' not in str(response.data)
+    assert 'in your cart' in str(response.data)
+
+def cart_benchmarks(self, baseline='cart-benchmarks.json'):
+    '''Benchmarks of the cart views, compared with the baseline'''
+    # the baseline is written by the first run (or CART_BENCHMARK_UPDATE)
+    results = benchmarks.run_benchmarks(self)
+    benchmarks.assert_baseline(results, baseline)
@@ -0,0 +1,932 @@
+import copy
+import datetime
+import time
+from collections import namedtuple
+from decimal import Decimal
+from functools import lru_cache
+from flask import current_app, session, g
+from galatea.tryton import tryton
+from galatea.utils import thumbnail
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+from .cache import LRUCache
+from .profiling import phase, set_cart_size
+from .stock import PRODUCT_TYPE_STOCK
+
+GALATEA_WEBSITE = current_app.config.get('TRYTON_GALATEA_SITE')
+SHOP = current_app.config.get('TRYTON_SALE_SHOP')
+# seconds to check again the write date of the website and the shop
+CONFIG_CACHE_TTL = current_app.config.get('TRYTON_CART_CONFIG_CACHE_TTL', 300)
+# seconds to reload the configuration although the write dates not changed
+CONFIG_CACHE_MAX_AGE = current_app.config.get(
+    'TRYTON_CART_CONFIG_CACHE_MAX_AGE', 3600)
+THUMBNAIL_CACHE_SIZE = current_app.config.get(
+    'TRYTON_CART_THUMBNAIL_CACHE_SIZE', 4096)
+PRODUCT_CODE_CACHE_TTL = current_app.config.get(
+    'TRYTON_CART_PRODUCT_CODE_CACHE_TTL', 600)
+PRODUCT_CODE_CACHE_SIZE = current_app.config.get(
+    'TRYTON_CART_PRODUCT_CODE_CACHE_SIZE', 50000)
+# seconds to check again the last write date of the products
+PRODUCT_CODE_CACHE_CHECK = current_app.config.get(
+    'TRYTON_CART_PRODUCT_CODE_CACHE_CHECK', 60)
+CARRIER_CACHE_TTL = current_app.config.get('TRYTON_CART_CARRIER_CACHE_TTL', 60)
+CARRIER_CACHE_SIZE = current_app.config.get(
+    'TRYTON_CART_CARRIER_CACHE_SIZE', 2048)
+CROSSSELL_CACHE_TTL = current_app.config.get(
+    'TRYTON_CART_CROSSSELL_CACHE_TTL', 3600)
+CROSSSELL_CACHE_SIZE = current_app.config.get(
+    'TRYTON_CART_CROSSSELL_CACHE_SIZE', 10000)
+# seconds to check again the last write date of the templates
+CROSSSELL_CACHE_CHECK = current_app.config.get(
+    'TRYTON_CART_CROSSSELL_CACHE_CHECK', 60)
+# seconds to check again the last write date of the countries
+COUNTRY_CACHE_CHECK = current_app.config.get(
+    'TRYTON_CART_COUNTRY_CACHE_CHECK', 300)
+# seconds to calculate again the cart summary saved in the session (the
+# cart of a user could be changed by other sessions)
+CART_SUMMARY_MAX_AGE = current_app.config.get(
+    'TRYTON_CART_SUMMARY_MAX_AGE', 300)
+
+Website = tryton.pool.get('galatea.website')
+Carrier = tryton.pool.get('carrier')
+Sale = tryton.pool.get('sale.sale')
+Party = tryton.pool.get('party.party')
+Product = tryton.pool.get('product.product')
+Template = tryton.pool.get('product.template')
+Shop = tryton.pool.get('sale.shop')
+SaleLine = tryton.pool.get('sale.line')
+Country = tryton.pool.get('country.country')
+Subdivision = tryton.pool.get('country.subdivision')
+
+
+ShopConfig = namedtuple('ShopConfig', [
+    'website',
+    'esale_stock',
+    'esale_stock_qty',
+    'shop',
+    'warehouse',
+    'currency_digits',
+    'currency_symbol',
+    'esale_country',
+    'esale_country_code',
+    'esale_countrys', # ((id, name), ...)
+    ])
+
+
+class ShopConfigCache(object):
+    '''
+    Website and shop settings used by the cart, loaded once by worker.
+
+    The snapshot is by language (country names are translatable) and it is
+    reloaded when the write date of the website or the shop changes (checked
+    each CONFIG_CACHE_TTL seconds) or after CONFIG_CACHE_MAX_AGE seconds.
+    '''
+    def __init__(self, ttl=CONFIG_CACHE_TTL, max_age=CONFIG_CACHE_MAX_AGE):
+        self.ttl = ttl
+        self.max_age = max_age
+        self._configs = {}
+
+    def get(self):
+        language = Transaction().language
+        now = time.time()
+        cached = self._configs.get(language)
+        if cached:
+            config, write_dates, checked, loaded = cached
+            if now - checked < self.ttl:
+                return config
+            if (now - loaded < self.max_age
+                    and self._write_dates() == write_dates):
+                self._configs[language] = (config, write_dates, now, loaded)
+                return config
+        config = self._load()
+        if config:
+            self._configs[language] = (config, self._write_dates(), now, now)
+        return config
+
+    def clear(self):
+        self._configs.clear()
+
+    @staticmethod
+    def _write_dates():
+        dates = []
+        for Model, id_ in ((Website, GALATEA_WEBSITE), (Shop, SHOP)):
+            records = Model.search_read([('id', '=', id_)], limit=1,
+                fields_names=['write_date'])
+            dates.append(records[0]['write_date'] if records else None)
+        return tuple(dates)
+
+    @staticmethod
+    def _load():
+        websites = Website.search([
+            ('id', '=', GALATEA_WEBSITE),
+            ], limit=1)
+        if not websites:
+            return
+        website, = websites
+        shop = Shop(SHOP)
+        return ShopConfig(
+            website=website.id,
+            esale_stock=website.esale_stock,
+            esale_stock_qty=website.esale_stock_qty,
+            shop=shop.id,
+            warehouse=shop.warehouse.id if shop.warehouse else None,
+            currency_digits=shop.currency.digits,
+            currency_symbol=shop.currency.symbol,
+            esale_country=shop.esale_country.id if shop.esale_country else None,
+            esale_country_code=(shop.esale_country.code
+                if shop.esale_country else None),
+            esale_countrys=tuple((c.id, c.name) for c in shop.esale_countrys),
+            )
+
+shop_config_cache = ShopConfigCache()
+
+
+def get_shop_config():
+    '''Return the website and shop settings (None if website not found)'''
+    return shop_config_cache.get()
+
+
+def cart_owner():
+    '''Key of the current cart: galatea user or session'''
+    if session.get('user'):
+        return ('user', session['user'])
+    return ('sid', session.sid)
+
+
+def cart_version():
+    '''Version of the current cart (changed each time the cart is written)'''
+    return session.get('cart_version', 0)
+
+
+def bump_cart_version():
+    session['cart_version'] = cart_version() + 1
+
+
+def cart_merged():
+    '''The session cart has been merged to the cart of the login user'''
+    return (bool(session.get('user'))
+        and session.get('cart_merged') == [session['user'], session.sid])
+
+
+def forget_cart_merged():
+    '''
+    Call it when lines of the session (sid without galatea user) are
+    written: an anonymous session that logs in again with the same sid
+    must merge the new lines.
+    '''
+    if not session.get('user'):
+        session.pop('cart_merged', None)
+
+
+def merge_session_cart(price_context=None):
+    '''
+    Move the cart lines of the session to the login user (one UPDATE) and
+    merge the lines of the same product (quantities are summed in the first
+    line). Done in a write transaction.
+
+    The session is marked as merged (cart_domain searches only the lines of
+    the user) when a read finds no lines left of the session, so a merge
+    that is rolled back is done again by the next request.
+    Return True if lines have been changed.
+    '''
+    if not session.get('user') or cart_merged():
+        return False
+    transaction = Transaction()
+    user = session['user']
+
+    cursor = transaction.connection.cursor()
+    table = SaleLine.__table__()
+    session_lines = ((table.sale == None)
+        & (table.shop == SHOP)
+        & (table.type == 'line')
+        & (table.sid == session.sid)
+        & (table.galatea_user == None))
+    cursor.execute(*table.select(table.id, where=session_lines, limit=1))
+    if not cursor.fetchone():
+        session['cart_merged'] = [user, session.sid]
+        return False
+    if transaction.readonly:
+        return False
+
+    cursor.execute(*table.update(
+            columns=[table.galatea_user, table.write_uid, table.write_date],
+            values=[user, transaction.user, CurrentTimestamp()],
+            where=session_lines))
+    moved = cursor.rowcount
+
+    changed = False
+    if moved:
+        lines = SaleLine.search([
+                ('sale', '=', None),
+                ('shop', '=', SHOP),
+                ('type', '=', 'line'),
+                ('galatea_user', '=', user),
+                ('product', '!=', None),
+                ], order=[('id', 'ASC')])
+        lines_by_product = {}
+        for line in lines:
+            lines_by_product.setdefault(line.product.id, []).append(line)
+        to_save = []
+        to_delete = []
+        with Transaction().set_context(price_context or {}):
+            for product_lines in lines_by_product.values():
+                if len(product_lines) < 2:
+                    continue
+                line = product_lines[0]
+                line.quantity = sum(l.quantity for l in product_lines)
+                line.on_change_quantity()
+                to_save.append(line)
+                to_delete.extend(product_lines[1:])
+        if to_save:
+            with Transaction().set_context(explode_kit=False):
+                SaleLine.save(to_save)
+            SaleLine.delete(to_delete)
+        changed = True
+
+    if changed:
+        bump_cart_version()
+        session.pop('cart_summary', None)
+    return changed
+
+
+def cart_domain():
+    '''Domain to search current cart lines by user or session'''
+    domain = [
+        ('sale', '=', None),
+        ('shop', '=', SHOP),
+        ('type', '=', 'line'),
+        ]
+    if cart_merged(): # login user (lines of the session moved to the user)
+        domain.append(
+            ('galatea_user', '=', session['user']),
+            )
+    elif session.get('user'): # login user
+        domain.append(['OR',
+            ('sid', '=', session.sid),
+            ('galatea_user', '=', session['user']),
+            ])
+    else: # anonymous user
+        domain.append(
+            ('sid', '=', session.sid),
+            )
+    return domain
+
+
+SUMMARY_KEYS = ('lines', 'quantity', 'untaxed', 'tax', 'total', 'stockable')
+
+
+def summarize_lines(lines):
+    '''
+    Totals of cart lines: number of lines, quantity, untaxed, tax and total
+    amounts and number of stockable lines
+    '''
+    summary = {
+        'lines': 0,
+        'quantity': 0.0,
+        'untaxed': Decimal(0),
+        'tax': Decimal(0),
+        'total': Decimal(0),
+        'stockable': 0,
+        }
+    for line in lines:
+        untaxed = line.amount or Decimal(0)
+        total = line.amount_w_tax or Decimal(0)
+        summary['lines'] += 1
+        summary['quantity'] += line.quantity or 0
+        summary['untaxed'] += untaxed
+        summary['tax'] += total - untaxed
+        summary['total'] += total
+        if line.product and line.product.type in PRODUCT_TYPE_STOCK:
+            summary['stockable'] += 1
+    return summary
+
+
+def summary_delta(before=None, after=None):
+    '''
+    Change of the cart totals from the summary of the written lines before
+    to the summary after (deleted lines are only before, created lines only
+    after)
+    '''
+    before = before or summarize_lines([])
+    after = after or summarize_lines([])
+    return dict((k, after[k] - before[k]) for k in SUMMARY_KEYS)
+
+
+def add_summary_delta(delta, other):
+    '''Sum two summary deltas'''
+    if delta is None:
+        return other
+    return dict((k, delta[k] + other[k]) for k in SUMMARY_KEYS)
+
+
+def _summary_key():
+    return [cart_version(), list(cart_owner()), session.get('customer')]
+
+
+def load_cart_summary():
+    '''Summary of the current cart saved in the session (None if stale)'''
+    data = session.get('cart_summary')
+    if (not data or data.get('key') != _summary_key()
+            or data['time'] + CART_SUMMARY_MAX_AGE < time.time()):
+        return None
+    return {
+        'lines': data['lines'],
+        'quantity': data['quantity'],
+        'untaxed': Decimal(data['untaxed']),
+        'tax': Decimal(data['tax']),
+        'total': Decimal(data['total']),
+        'stockable': data['stockable'],
+        }
+
+
+def save_cart_summary(summary, created=None):
+    session['cart_summary'] = {
+        'key': _summary_key(),
+        'time': created or time.time(),
+        'lines': summary['lines'],
+        'quantity': summary['quantity'],
+        'untaxed': str(summary['untaxed']),
+        'tax': str(summary['tax']),
+        'total': str(summary['total']),
+        'stockable': summary['stockable'],
+        }
+
+
+def cart_summary_json(summary):
+    '''Summary as JSON values (amounts as strings)'''
+    return {
+        'lines': summary['lines'],
+        'quantity': summary['quantity'],
+        'untaxed': str(summary['untaxed']),
+        'tax': str(summary['tax']),
+        'total': str(summary['total']),
+        'stockable': summary['stockable'] > 0,
+        }
+
+
+class CartSession(object):
+    '''
+    Current cart of the request.
+
+    Lines, party, price list context and the products and templates of the
+    lines are resolved once and shared by all views and forms of the request.
+    Use get_cart_session() to get the instance of the current request.
+    '''
+    def __init__(self):
+        self._config = None
+        self._shop = None
+        self._lines = None
+        self._party = None
+        self._products = None
+        self._templates = None
+
+    @property
+    def config(self):
+        '''Website and shop settings (ShopConfig)'''
+        if self._config is None:
+            with phase('config'):
+                self._config = get_shop_config()
+        return self._config
+
+    @property
+    def shop(self):
+        if self._shop is None:
+            self._shop = Shop(SHOP)
+        return self._shop
+
+    def _load(self):
+        if self._lines is not None:
+            return
+        merge_session_cart(self.price_context)
+        with phase('lines'):
+            lines = SaleLine.search(cart_domain())
+            # browse products and templates together, so the first access to
+            # a product or template field reads all records of the cart at
+            # once
+            product_ids = {l.product.id for l in lines if l.product}
+            products = Product.browse(list(product_ids))
+            template_ids = {p.template.id for p in products}
+            self._templates = Template.browse(list(template_ids))
+        set_cart_size(len(lines))
+        self._products = products
+        self._lines = lines
+
+    @property
+    def lines(self):
+        '''Cart lines (a new list, so views could extend it)'''
+        self._load()
+        return list(self._lines)
+
+    @property
+    def products(self):
+        '''Products of the cart lines'''
+        self._load()
+        return self._products
+
+    @property
+    def templates(self):
+        '''Templates of the cart lines'''
+        self._load()
+        return self._templates
+
+    @property
+    def party(self):
+        if self._party is None and session.get('customer'):
+            self._party = Party(session['customer'])
+        return self._party
+
+    @property
+    def price_context(self):
+        '''Context to calculate the prices of the cart lines'''
+        context = {}
+        context['customer'] = session.get('customer', None)
+        party = self.party
+        if party and getattr(party, 'sale_price_list', None):
+            context['price_list'] = party.sale_price_list.id
+        return context
+
+    @property
+    def summary(self):
+        '''
+        Totals of the cart (see summarize_lines). Calculated from the lines
+        when they are loaded; otherwise the summary kept in the session
+        (updated with the changes of the written lines) is used and it is
+        calculated from all lines when it is missing or stale.
+        '''
+        summary = load_cart_summary()
+        if self._lines is not None:
+            lines_summary = summarize_lines(self._lines)
+            if lines_summary != summary:
+                save_cart_summary(lines_summary)
+            return lines_summary
+        if summary is None:
+            summary = summarize_lines(self.lines)
+            save_cart_summary(summary)
+        return summary
+
+    def invalidate(self, delta=None):
+        '''
+        Reload the lines next time (call it after write the cart lines).
+        delta is the change of the totals (summary_delta) of the written
+        lines; without it the summary is calculated again.
+        '''
+        summary = load_cart_summary() if delta is not None else None
+        created = session['cart_summary']['time'] if summary else None
+        bump_cart_version()
+        if summary is not None:
+            # keep the time of the calculation from all lines
+            save_cart_summary(add_summary_delta(summary, delta), created)
+        else:
+            session.pop('cart_summary', None)
+        self._lines = None
+        self._products = None
+        self._templates = None
+
+
+def _dotted_value(record, name):
+    # trytond returns the dotted fields flat ('product.code') or nested in a
+    # dict by relation ('product.': {'code': ...}) depending on the version
+    if name in record:
+        return record[name]
+    path = name.split('.')
+    value = record
+    for relation in path[:-1]:
+        value = value.get(relation + '.') if value else None
+    return value.get(path[-1]) if value else None
+
+
+def read_cart_lines(fields_names, domain=None):
+    '''
+    Read the fields of the current cart lines with one search_read and
+    return them as dicts {field name: value} (with the id). Dotted names
+    read the fields of the relations, as 'product.template.esale_slug'.
+    '''
+    with phase('lines'):
+        records = SaleLine.search_read(domain or cart_domain(),
+            fields_names=list(fields_names))
+    set_cart_size(len(records))
+    return [dict([('id', r['id'])]
+            + [(name, _dotted_value(r, name)) for name in fields_names])
+        for r in records]
+
+
+def summarize_rows(rows):
+    '''
+    summarize_lines() of lines read by read_cart_lines with quantity,
+    amount, amount_w_tax and product.type
+    '''
+    summary = summarize_lines([])
+    for row in rows:
+        untaxed = row['amount'] or Decimal(0)
+        total = row['amount_w_tax'] or Decimal(0)
+        summary['lines'] += 1
+        summary['quantity'] += row['quantity'] or 0
+        summary['untaxed'] += untaxed
+        summary['tax'] += total - untaxed
+        summary['total'] += total
+        if row['product.type'] in PRODUCT_TYPE_STOCK:
+            summary['stockable'] += 1
+    return summary
+
+
+def get_cart_session():
+    '''Return the cart of the current request'''
+    if 'cart_session' not in g:
+        g.cart_session = CartSession()
+    return g.cart_session
+
+
+@lru_cache(maxsize=THUMBNAIL_CACHE_SIZE)
+def cached_thumbnail(digest, name, size):
+    '''thumbnail() memoized by image digest and size'''
+    return thumbnail(digest, name, size)
+
+
+def get_images(template_ids, size='200x200', image='small'):
+    '''
+    Return the thumbnail url of the default image of the templates
+    {template id: url}, reading the images of all templates at once.
+    '''
+    base_image = current_app.config.get('BASE_IMAGE')
+    images = {}
+    if not template_ids:
+        return images
+    for values in Template.read(list(template_ids), ['esale_default_images']):
+        img = values['esale_default_images'] or {}
+        if img.get(image):
+            images[values['id']] = cached_thumbnail(
+                img[image]['digest'], img[image]['name'], size)
+        else:
+            images[values['id']] = base_image
+    return images
+
+
+carrier_cache = LRUCache(CARRIER_CACHE_SIZE, ttl=CARRIER_CACHE_TTL)
+
+
+def get_carriers(shop, party=None, untaxed=0, tax=0, total=0, payment=None,
+        address_id=None, postal_code=None, country=None, digits=2):
+    '''
+    Sale.get_esale_carriers() memoized by its arguments. Amounts are rounded
+    at the currency digits, so the same cart always gets the same quote.
+    '''
+    exp = Decimal(10) ** -digits
+    untaxed = Decimal(untaxed or 0).quantize(exp)
+    tax = Decimal(tax or 0).quantize(exp)
+    total = Decimal(total or 0).quantize(exp)
+
+    def id_(value):
+        return getattr(value, 'id', value)
+
+    key = (id_(shop), id_(party), untaxed, tax, total, id_(payment),
+        id_(address_id), postal_code, id_(country), Transaction().language)
+    quotes = carrier_cache.get(key)
+    if quotes is None:
+        with phase('carriers'):
+            carriers = Sale.get_esale_carriers(
+                shop=shop,
+                party=party,
+                untaxed=untaxed,
+                tax=tax,
+                total=total,
+                payment=payment,
+                address_id=address_id,
+                postal_code=postal_code,
+                country=country,
+                )
+            quotes = tuple((c['carrier'].id, c['carrier'].rec_name,
+                    c['price'], c['price_w_tax']) for c in carriers)
+        carrier_cache.set(key, quotes)
+    return [{
+        'carrier': Carrier(carrier_id),
+        'name': name,
+        'price': price,
+        'price_w_tax': price_w_tax,
+        } for carrier_id, name, price, price_w_tax in quotes]
+
+
+def invalidate_carriers():
+    '''Clear the carrier quotes (call it after change carrier prices)'''
+    carrier_cache.clear()
+
+
+default_values_cache = LRUCache(64)
+
+
+def get_default_values(Model):
+    '''
+    Model.default_get() of all fields, cached by worker and returned as a
+    copy. The key has the model class (a new class when the pool reloads),
+    the date, the user, the company and the language.
+    '''
+    transaction = Transaction()
+    key = (Model, datetime.date.today(), transaction.user,
+        transaction.context.get('company'), transaction.language)
+    defaults = default_values_cache.get(key)
+    if defaults is None:
+        defaults = Model.default_get(list(Model._fields.keys()),
+            with_rec_name=False)
+        default_values_cache.set(key, defaults)
+    return copy.deepcopy(defaults)
+
+
+_missing = object()
+
+
+def last_write_date(*Models):
+    '''Last write (or create) date of the records of each model'''
+    cursor = Transaction().connection.cursor()
+    write_dates = []
+    for Model in Models:
+        table = Model.__table__()
+        cursor.execute(*table.select(
+                Max(Coalesce(table.write_date, table.create_date))))
+        write_dates.append(cursor.fetchone()[0])
+    return tuple(write_dates)
+
+
+class WriteDateCache(object):
+    '''
+    Base of the caches by worker that are cleared when the last write date
+    of its models changes (checked each check_interval seconds).
+    Subclasses set _models and clear their values in _clear.
+    '''
+    _models = ()
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._write_date = None
+        self._checked = 0
+
+    def _check_write_date(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        write_date = last_write_date(*self._models)
+        if write_date != self._write_date:
+            self._clear()
+            self._write_date = write_date
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def clear(self):
+        self._clear()
+        self._write_date = None
+        self._checked = 0
+
+
+class ProductCodeResolver(WriteDateCache):
+    '''
+    Salable product ids by code (and customer code), cached by worker.
+
+    Codes are normalized (upper case, without spaces), so the lookups are
+    case insensitive. Found and not found codes are kept ttl seconds and all
+    codes are cleared when the last write date of the products or templates
+    changes (checked each check_interval seconds).
+    '''
+    _models = (Product, Template)
+
+    def __init__(self, ttl=PRODUCT_CODE_CACHE_TTL,
+            size_limit=PRODUCT_CODE_CACHE_SIZE,
+            check_interval=PRODUCT_CODE_CACHE_CHECK):
+        super(ProductCodeResolver, self).__init__(check_interval)
+        self.cache = LRUCache(size_limit, ttl=ttl)
+
+    @staticmethod
+    def normalize(code):
+        return str(code).strip().upper()
+
+    def resolve(self, codes, customer_code=False):
+        '''Return {normalized code: product id} of the found codes'''
+        self._check_write_date()
+        customer_code = customer_code and hasattr(Product, 'customer_code')
+        # customer codes could depend on the customer of the context
+        customer = (Transaction().context.get('customer')
+            if customer_code else False)
+
+        codes_by_key = {}
+        for code in codes:
+            if code:
+                codes_by_key.setdefault(self.normalize(code), set()).add(
+                    str(code).strip())
+
+        result = {}
+        missing = {}
+        for code, variants in codes_by_key.items():
+            product_id = self.cache.get((code, customer), _missing)
+            if product_id is _missing:
+                missing[code] = variants
+            elif product_id:
+                result[code] = product_id
+
+        if missing:
+            found = self._search(missing, customer_code)
+            for code in missing:
+                product_id = found.get(code)
+                # not found codes are cached too (None)
+                self.cache.set((code, customer), product_id)
+                if product_id:
+                    result[code] = product_id
+        return result
+
+    def _search(self, codes, customer_code):
+        found = {}
+        for sub_codes in grouped_slice(list(codes.keys()), 1000):
+            variants = set()
+            for code in sub_codes:
+                variants.add(code)
+                variants.add(code.lower())
+                variants.update(codes[code])
+            variants = list(variants)
+
+            domain = [('salable', '=', True)]
+            if customer_code:
+                domain.append(['OR',
+                    ('customer_code', 'in', variants),
+                    ('code', 'in', variants),
+                    ])
+            else:
+                domain.append(('code', 'in', variants))
+            products = Product.search(domain)
+            for product in products:
+                if product.code:
+                    found[self.normalize(product.code)] = product.id
+            # customer codes have priority to codes
+            if customer_code:
+                for product in products:
+                    if product.customer_code:
+                        found[self.normalize(product.customer_code)] = product.id
+        return found
+
+    def _clear(self):
+        self.cache.clear()
+
+product_code_resolver = ProductCodeResolver()
+
+
+class CrossSellIndex(WriteDateCache):
+    '''
+    Cross sell template ids of each template of the shop
+    (esale_crosssells_by_shop), in its order, cached by worker.
+
+    Templates are kept ttl seconds and all are cleared when the last write
+    date of the templates changes (checked each check_interval seconds).
+    '''
+    _models = (Template,)
+
+    def __init__(self, ttl=CROSSSELL_CACHE_TTL,
+            size_limit=CROSSSELL_CACHE_SIZE,
+            check_interval=CROSSSELL_CACHE_CHECK):
+        super(CrossSellIndex, self).__init__(check_interval)
+        self.cache = LRUCache(size_limit, ttl=ttl)
+
+    def get(self, template_ids):
+        '''Return {template id: (cross sell template id, ...)}'''
+        self._check_write_date()
+        result = {}
+        missing = []
+        for template_id in template_ids:
+            crosssells = self.cache.get((SHOP, template_id))
+            if crosssells is None:
+                missing.append(template_id)
+            else:
+                result[template_id] = crosssells
+        if missing:
+            for template in Template.browse(missing):
+                crosssells = tuple(c.id
+                    for c in template.esale_crosssells_by_shop)
+                self.cache.set((SHOP, template.id), crosssells)
+                result[template.id] = crosssells
+        return result
+
+    def select(self, template_ids, limit=None):
+        '''
+        Cross sell template ids of the templates (of a cart), without the
+        templates. Ranked by the number of templates that have the cross
+        sell, its best position and its id.
+        '''
+        template_ids = set(template_ids)
+        ranks = {}
+        for crosssells in self.get(sorted(template_ids)).values():
+            for position, crosssell_id in enumerate(crosssells):
+                if crosssell_id in template_ids:
+                    continue
+                count, best = ranks.get(crosssell_id, (0, position))
+                ranks[crosssell_id] = (count + 1, min(best, position))
+        selected = sorted(ranks,
+            key=lambda i: (-ranks[i][0], ranks[i][1], i))
+        return selected[:limit] if limit else selected
+
+    def _clear(self):
+        self.cache.clear()
+
+crosssell_index = CrossSellIndex()
+
+
+Place = namedtuple('Place', ['id', 'code', 'name', 'country'])
+
+
+class CountryLookup(WriteDateCache):
+    '''
+    Countries and subdivisions by language (names are translatable),
+    cached by worker as Place tuples. Subdivisions are loaded by country.
+
+    All are cleared when the last write date of the countries or
+    subdivisions changes (checked each check_interval seconds).
+    '''
+    _models = (Country, Subdivision)
+
+    def __init__(self, check_interval=COUNTRY_CACHE_CHECK):
+        super(CountryLookup, self).__init__(check_interval)
+        self._countries = {}
+        self._subdivisions = {}
+        self._subdivisions_by_id = {}
+
+    @staticmethod
+    def _id(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def countries(self):
+        '''Return {country id: Place}'''
+        self._check_write_date()
+        language = Transaction().language
+        countries = self._countries.get(language)
+        if countries is None:
+            countries = dict((c['id'], Place(c['id'], c['code'], c['name'],
+                        c['id'])) for c in Country.search_read([],
+                    fields_names=['code', 'name']))
+            self._countries[language] = countries
+        return countries
+
+    def country(self, country_id):
+        '''Return the Place of the country (None if not found)'''
+        return self.countries().get(self._id(country_id))
+
+    def subdivisions(self, country_id):
+        '''Return the Places of the subdivisions of a country, by name'''
+        self._check_write_date()
+        country_id = self._id(country_id)
+        language = Transaction().language
+        key = (language, country_id)
+        subdivisions = self._subdivisions.get(key)
+        if subdivisions is None:
+            subdivisions = tuple(Place(s['id'], s['code'], s['name'],
+                    country_id) for s in Subdivision.search_read([
+                        ('country', '=', country_id),
+                        ], order=[('name', 'ASC')],
+                    fields_names=['code', 'name']))
+            self._subdivisions[key] = subdivisions
+            for subdivision in subdivisions:
+                self._subdivisions_by_id[(language, subdivision.id)] = (
+                    subdivision)
+        return subdivisions
+
+    def subdivision(self, subdivision_id):
+        '''Return the Place of the subdivision (None if not found)'''
+        self._check_write_date()
+        subdivision_id = self._id(subdivision_id)
+        if not subdivision_id:
+            return
+        language = Transaction().language
+        subdivision = self._subdivisions_by_id.get((language, subdivision_id))
+        if subdivision is None:
+            records = Subdivision.search_read([
+                    ('id', '=', subdivision_id),
+                    ], limit=1, fields_names=['country'])
+            if records and records[0]['country']:
+                # load all the subdivisions of its country
+                self.subdivisions(records[0]['country'])
+                subdivision = self._subdivisions_by_id.get(
+                    (language, subdivision_id))
+        return subdivision
+
+    def search_subdivisions(self, country_id, prefix=None, limit=None):
+        '''Subdivisions of a country with the name or code starting by prefix'''
+        subdivisions = self.subdivisions(country_id)
+        if prefix:
+            prefix = prefix.strip().lower()
+            subdivisions = [s for s in subdivisions
+                if s.name.lower().startswith(prefix)
+                or (s.code or '').lower().startswith(prefix)
+                or (s.code or '').lower().split('-', 1)[-1].startswith(prefix)]
+        return list(subdivisions[:limit] if limit else subdivisions)
+
+    def generation(self):
+        '''Last write date of the countries and subdivisions (cache keys)'''
+        self._check_write_date()
+        return self._write_date
+
+    def _clear(self):
+        self._countries.clear()
+        self._subdivisions.clear()
+        self._subdivisions_by_id.clear()
+
+country_lookup = CountryLookup()
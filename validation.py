@@ -0,0 +1,42 @@
+import stdnum.eu.vat as vat
+from flask import current_app
+from emailvalid import check_email
+from .cache import LRUCache
+
+# seconds to keep the result of the validations
+VALIDATION_CACHE_TTL = current_app.config.get('TRYTON_CART_VALIDATION_CACHE_TTL', 3600)
+VALIDATION_CACHE_SIZE = current_app.config.get('TRYTON_CART_VALIDATION_CACHE_SIZE', 10000)
+# longer values are not valid (and not checked)
+MAX_LENGTH = 254
+
+email_cache = LRUCache(VALIDATION_CACHE_SIZE, ttl=VALIDATION_CACHE_TTL)
+vat_cache = LRUCache(VALIDATION_CACHE_SIZE, ttl=VALIDATION_CACHE_TTL)
+
+
+def is_valid_email(email):
+    '''check_email() memoized by worker (it could look up the domain)'''
+    if not email or len(email) > MAX_LENGTH:
+        return False
+    key = email.strip().lower()
+    valid = email_cache.get(key)
+    if valid is None:
+        valid = bool(check_email(email.strip()))
+        email_cache.set(key, valid)
+    return valid
+
+
+def vat_number(vat_country, vat_code):
+    '''European VAT number of a country and a code'''
+    return '%s%s' % (vat_country.upper(), vat_code)
+
+
+def is_valid_vat(number):
+    '''stdnum.eu.vat.is_valid() memoized by worker'''
+    if not number or len(number) > MAX_LENGTH:
+        return False
+    key = ''.join(number.split()).upper()
+    valid = vat_cache.get(key)
+    if valid is None:
+        valid = bool(vat.is_valid(number))
+        vat_cache.set(key, valid)
+    return valid